@@ -38,8 +38,9 @@ class LgbmExplainer(LgbmInit):
         # Find best epoch
         self.load_progress_list()
 
+        #early stopping can end before n_round
         progress_dict = {
-            'time': range(self.params_lgb['n_round']),
+            'time': range(len(self.progress_list[0]['valid'][self.metric_eval])),
         }
 
         progress_dict.update(
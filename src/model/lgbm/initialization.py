@@ -7,13 +7,17 @@ import lightgbm as lgb
 
 from typing import Any, Union
 
+from src.utils.matrix_utils import load_fold_info
+
 class LgbmInit():
     def __init__(self, 
             experiment_name:str, 
             params_lgb: dict[str, Any],
             metric_eval: str,
             config_dict: dict[str, Any], inference_setup: str=None,
-            log_evaluation:int =1, fold_name: str = 'fold_info', use_importance_filter: bool = False, number_importance_feature: int = None
+            log_evaluation:int =1, use_importance_filter: bool = False, number_importance_feature: int = None,
+            use_binned_dataset: bool = False, n_parallel_fold: int = 1, thread_budget: int = None,
+            use_feature_store: bool = False, early_stopping_round: int = None, checkpoint_round: int = 100
         ):
         if inference_setup is None:
             self.inference_setup = 'blend'
@@ -34,7 +38,10 @@ class LgbmInit():
         self.n_fold: int = config_dict['N_FOLD']
         
         self.target_col_name: str = config_dict['TARGET_COL']
-        self.fold_name: str = fold_name
+        #fold column and code are read from the data manifest by load_fold_info
+        self.fold_name: str = None
+        self.fold_col_list: list[str] = None
+        self.fold_code_dict: dict[str, int] = None
         self.useless_col_list: list[str] = [
             'datetime', 'date', 'date_order_kfold',
             'data_block_id', 'prediction_unit_id',
@@ -59,9 +66,34 @@ class LgbmInit():
             "is_consumption",
         ]
         self.log_evaluation: int = log_evaluation
+        #number of fold trained together and total thread used by them -> None every core
+        self.n_parallel_fold: int = n_parallel_fold
+        self.thread_budget: int = thread_budget
+        #read training matrix from the memory mapped feature store in PATH_PARQUET_DATA instead of data.parquet
+        self.use_feature_store: bool = use_feature_store
+        #folds boosted together and stopped when the cv average stops improving for early_stopping_round rounds.
+        #None -> every fold runs n_round. progress and models are checkpointed every checkpoint_round rounds
+        if (early_stopping_round is not None) and (n_parallel_fold > 1):
+            raise ValueError(
+                'early_stopping_round trains folds in lockstep in one process: set n_parallel_fold=1'
+            )
+        
+        self.early_stopping_round: int = early_stopping_round
+        self.checkpoint_round: int = checkpoint_round
         self.data: pl.LazyFrame = None
         self.params_lgb: dict[str, Any] = params_lgb
         
+        #bin all labelled rows once in a binary lgb dataset and subset it by fold
+        self.use_binned_dataset: bool = use_binned_dataset
+        #params which change the binned dataset
+        self.binned_dataset_param_list: list[str] = [
+            'max_bin', 'max_bin_by_feature', 'min_data_in_bin', 
+            'bin_construct_sample_cnt', 'data_random_seed', 'seed',
+            'min_data_in_leaf', 'min_sum_hessian_in_leaf', 'feature_pre_filter',
+            'use_missing', 'zero_as_missing', 'enable_bundle', 'is_enable_sparse',
+            'max_cat_to_onehot', 'linear_tree', 'forcedbins_filename'
+        ]
+        
         self.model_all_data: lgb.Booster = None
         self.model_list: list[lgb.Booster] = []
         self.progress_list: list = []
@@ -109,6 +141,17 @@ class LgbmInit():
         if not os.path.isdir(self.experiment_path):
             os.makedirs(self.experiment_path)
 
+    def load_fold_info(self) -> None:
+        fold_info = load_fold_info(self.config_dict['PATH_PARQUET_DATA'])
+        if len(fold_info['fold_col_list']) != self.n_fold:
+            raise ValueError(
+                f'N_FOLD is {self.n_fold}, data has {len(fold_info["fold_col_list"])} fold'
+            )
+        
+        self.fold_name = fold_info['fold_name']
+        self.fold_col_list = fold_info['fold_col_list']
+        self.fold_code_dict = fold_info['fold_code_dict']
+
     def load_model(self) -> None: 
         self.load_used_feature()
         self.load_best_result()
@@ -11,12 +11,17 @@ class LgbmPipeline(LgbmTrainer, LgbmExplainer, LgbmInference):
             params_lgb: dict[str, Any],
             metric_eval: str,
             config_dict: dict[str, Any], inference_setup: str=None,
-            log_evaluation:int =1, fold_name: str = 'fold_info', use_importance_filter: bool = False, number_importance_feature: int = None
+            log_evaluation:int =1, use_importance_filter: bool = False, number_importance_feature: int = None,
+            use_binned_dataset: bool = False, n_parallel_fold: int = 1, thread_budget: int = None,
+            use_feature_store: bool = False, early_stopping_round: int = None, checkpoint_round: int = 100
         ):
         LgbmInit.__init__(
             self, experiment_name=experiment_name, params_lgb=params_lgb,
             metric_eval=metric_eval, config_dict=config_dict, inference_setup=inference_setup,
-            log_evaluation=log_evaluation, fold_name=fold_name, use_importance_filter=use_importance_filter, number_importance_feature = number_importance_feature
+            log_evaluation=log_evaluation, use_importance_filter=use_importance_filter, number_importance_feature = number_importance_feature,
+            use_binned_dataset=use_binned_dataset, n_parallel_fold=n_parallel_fold, thread_budget=thread_budget,
+            use_feature_store=use_feature_store, early_stopping_round=early_stopping_round, 
+            checkpoint_round=checkpoint_round
         )
 
     def activate_inference(self) -> None:
@@ -1,12 +1,90 @@
 import os
 import gc
+import json
+import shutil
+import pickle
+import hashlib
+import numpy as np
 import polars as pl
 import lightgbm as lgb
 
+from glob import glob
+from typing import Any, Dict, Tuple
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+
+from src.utils.matrix_utils import (
+    load_feature_matrix, load_target_array, get_candidate_feature_list,
+    prepare_feature_store, load_store_view_list, load_store_fold,
+    get_store_fold_index, get_labelled_fold_index
+)
 from src.model.lgbm.initialization import LgbmInit
 
+def fit_fold(
+        fold_: int, params_lgb: dict[str, Any], log_evaluation: int, experiment_path: str,
+        train_matrix: lgb.Dataset, test_matrix: lgb.Dataset
+    ) -> Tuple[lgb.Booster, dict]:
+    progress = {}
+
+    callbacks_list = [
+        lgb.record_evaluation(progress),
+        lgb.log_evaluation(
+            period=log_evaluation, 
+            show_stdv=False
+        )
+    ]
+    print('Start training')
+    model = lgb.train(
+        params=params_lgb,
+        train_set=train_matrix, 
+        num_boost_round=params_lgb['n_round'],
+        valid_sets=[test_matrix],
+        valid_names=['valid'],
+        callbacks=callbacks_list,
+    )
+
+    model.save_model(
+        os.path.join(
+            experiment_path,
+            f'lgb_{fold_}.txt'
+        ), importance_type='gain'
+    )
+    return model, progress
+
+def train_fold_worker(
+        fold_: int, params_lgb: dict[str, Any], log_evaluation: int, experiment_path: str,
+        feature_list: list[str], categorical_col_list: list[str],
+        train_index: np.ndarray, test_index: np.ndarray,
+        store_path: str, binned_fold_path: Tuple[str, str] = None, binned_params: dict[str, Any] = None
+    ) -> Tuple[lgb.Booster, dict]:
+    #run inside a worker process: every worker maps the same feature store, fold rows are read from the map.
+    #with binned dataset each worker loads only the binned train and valid subset of its fold
+    print(f'Starting fold {fold_}: {len(train_index)} train rows; {len(test_index)} test rows')
+    if binned_fold_path is None:
+        fold_dict = load_store_fold(store_path=store_path, train_index=train_index, test_index=test_index)
+        
+        train_matrix = lgb.Dataset(
+            *fold_dict['train'],
+            feature_name=feature_list,
+            categorical_feature=categorical_col_list
+        )
+        test_matrix = lgb.Dataset(
+            *fold_dict['valid'],
+            feature_name=feature_list,
+            categorical_feature=categorical_col_list
+        )
+    else:
+        train_matrix = lgb.Dataset(binned_fold_path[0], params=binned_params)
+        test_matrix = lgb.Dataset(binned_fold_path[1], reference=train_matrix, params=binned_params)
+    
+    return fit_fold(
+        fold_=fold_, params_lgb=params_lgb, log_evaluation=log_evaluation, 
+        experiment_path=experiment_path, train_matrix=train_matrix, test_matrix=test_matrix
+    )
+
 class LgbmTrainer(LgbmInit):
     def _init_train(self) -> None:
+        self.load_fold_info()
         data = pl.scan_parquet(
             os.path.join(
                 self.config_dict['PATH_PARQUET_DATA'],
@@ -15,10 +93,11 @@ class LgbmTrainer(LgbmInit):
         )
         if self.importance_feature_list is None:
             print('Using all feature')
-            self.feature_list = [
-                col for col in data.columns
-                if col not in self.useless_col_list + [self.fold_name, self.target_col_name]
-            ]
+            self.feature_list = get_candidate_feature_list(
+                column_list=data.columns, 
+                excluded_col_list=self.useless_col_list + [self.target_col_name], 
+                fold_col_list=self.fold_col_list
+            )
         else:
             print(f'Using top {len(self.importance_feature_list)} feature')
             self.feature_list = (
@@ -35,85 +114,443 @@ class LgbmTrainer(LgbmInit):
                 'data.parquet'
             )
         )
+        #fold membership is a UInt8 column -> filter on it is pushed down to the scan
         fold_data = fold_data.with_columns(
-            (
-                pl.col('fold_info').str.split(', ')
-                .list.get(fold_).alias('current_fold')
-            )
+            pl.col(self.fold_col_list[fold_]).alias('current_fold')
         )
         return fold_data
 
-    def train(self) -> None:
+    def load_fold(self, fold_: int) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        #single read of the fold, then split in memory
+        fold_data = self.access_fold(fold_=fold_).filter(
+            (pl.col('current_fold') != self.fold_code_dict['n']) &
+            (pl.col('target').is_not_null())
+        ).select(
+            self.feature_list + [self.target_col_name, 'date', 'current_fold']
+        ).collect()
         
-        self._init_train()
+        train_data = fold_data.filter(pl.col('current_fold') == self.fold_code_dict['t'])
+        test_data = fold_data.filter(pl.col('current_fold') == self.fold_code_dict['v'])
+        del fold_data
         
-        for fold_ in range(self.n_fold):
-            print(f'\n\nStarting fold {fold_}\n\n\n')
-            
-            progress = {}
+        assert len(
+            set(train_data['date'].unique().to_list()).intersection(
+                test_data['date'].unique().to_list()
+            )
+        ) == 0
+        
+        return train_data, test_data
 
-            callbacks_list = [
-                lgb.record_evaluation(progress),
-                lgb.log_evaluation(
-                    period=self.log_evaluation, 
-                    show_stdv=False
-                )
-            ]
-            print('Collecting dataset')
-            fold_data = self.access_fold(fold_=fold_)
+    def _get_binned_dataset_path(self) -> str:
+        #new binned file for any change of data, feature or bin params
+        data_path = os.path.join(
+            self.config_dict['PATH_PARQUET_DATA'],
+            'data.parquet'
+        )
+        data_stat = os.stat(data_path)
+        binned_key = hashlib.md5(
+            json.dumps(
+                {
+                    'data': [data_stat.st_size, data_stat.st_mtime_ns],
+                    'feature': self.feature_list,
+                    'categorical': self.categorical_col_list,
+                    'param': {
+                        param: value for param, value in self.params_lgb.items()
+                        if param in self.binned_dataset_param_list
+                    },
+                    'lightgbm': lgb.__version__
+                }
+            ).encode()
+        ).hexdigest()
+        return os.path.join(
+            self.config_dict['PATH_PARQUET_DATA'],
+            f'lgb_dataset_{binned_key}.bin'
+        )
+    
+    def _get_binned_dataset_params(self) -> dict[str, Any]:
+        return {
+            param: value for param, value in self.params_lgb.items()
+            if param in self.binned_dataset_param_list + ['verbosity', 'verbose']
+        }
+    
+    def load_binned_dataset(self) -> lgb.Dataset:
+        #every labelled row of data.parquet, in file order, binned once
+        binned_path = self._get_binned_dataset_path()
+        dataset_params = self._get_binned_dataset_params()
+        
+        if not os.path.exists(binned_path):
+            for old_binned_path in glob(
+                os.path.join(self.config_dict['PATH_PARQUET_DATA'], 'lgb_dataset_*.bin')
+            ):
+                os.remove(old_binned_path)
             
-            train_filtered = fold_data.filter(
-                (pl.col('current_fold') == 't') &
-                (pl.col('target').is_not_null())
-            )
-            test_filtered = fold_data.filter(
-                (pl.col('current_fold') == 'v') &
+            print('Binning labelled dataset')
+            data = pl.scan_parquet(
+                os.path.join(
+                    self.config_dict['PATH_PARQUET_DATA'],
+                    'data.parquet'
+                )
+            ).filter(
                 (pl.col('target').is_not_null())
+            ).select(self.feature_list + [self.target_col_name]).collect()
+            
+            binned_dataset = lgb.Dataset(
+                load_feature_matrix(data, self.feature_list, order='F'),
+                load_target_array(data, self.target_col_name),
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list,
+                params=dataset_params
+            ).construct()
+            del data
+            
+            #write on temporary file so a killed run doesn't leave a corrupted dataset
+            binned_dataset.save_binary(binned_path + '.tmp')
+            os.replace(binned_path + '.tmp', binned_path)
+            
+            del binned_dataset
+            _ = gc.collect()
+        
+        return lgb.Dataset(binned_path, params=dataset_params).construct()
+    
+    def prepare_binned_fold_list(self, fold_index_list: list[Tuple[np.ndarray, np.ndarray]]) -> list[Tuple[str, str]]:
+        #binned train and valid subset of each fold saved once next to the binned dataset
+        #-> a fold worker never holds the whole binned dataset
+        binned_name, _ = os.path.splitext(self._get_binned_dataset_path())
+        binned_fold_path_list = [
+            tuple(
+                f'{binned_name}_fold_{fold_}_{split}.bin'
+                for split in ['train', 'valid']
             )
+            for fold_ in range(self.n_fold)
+        ]
+        if not all(
+            os.path.exists(fold_path) 
+            for fold_path_tuple in binned_fold_path_list for fold_path in fold_path_tuple
+        ):
+            print('Saving binned fold')
+            binned_dataset = self.load_binned_dataset()
+            
+            for fold_path_tuple, fold_index_tuple in zip(binned_fold_path_list, fold_index_list):
+                for fold_path, fold_index in zip(fold_path_tuple, fold_index_tuple):
+                    binned_dataset.subset(fold_index).construct().save_binary(fold_path + '.tmp')
+                    os.replace(fold_path + '.tmp', fold_path)
+            
+            del binned_dataset
+            _ = gc.collect()
+        
+        return binned_fold_path_list
+    
+    def get_feature_store(self) -> Dict[str, Any]:
+        return prepare_feature_store(
+            data_path=os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'data.parquet'
+            ),
+            store_root_path=os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'feature_store'
+            ),
+            feature_list=self.feature_list, target_col=self.target_col_name,
+            fold_col_list=self.fold_col_list,
+            date_col='date'
+        )
+    
+    def _get_fold_params(self) -> dict[str, Any]:
+        #split the thread budget between the folds trained together
+        if (self.thread_budget is None) and (self.n_parallel_fold == 1):
+            return self.params_lgb
+        
+        thread_budget = self.thread_budget if self.thread_budget is not None else os.cpu_count()
+        fold_params = {
+            param: value for param, value in self.params_lgb.items()
+            if param not in ['num_threads', 'num_thread', 'nthread', 'nthreads', 'n_jobs']
+        }
+        fold_params['num_threads'] = max(1, thread_budget // self.n_parallel_fold)
+        return fold_params
+    
+    def parallel_train(self) -> None:
+        #n_parallel_fold worker processes, each fold reads the shared feature store by memory map
+        print(f'Training {self.n_parallel_fold} fold together')
+        assert self.target_col_name not in self.feature_list
+        
+        store_path, binned_fold_path_list, binned_params = None, [None] * self.n_fold, None
+        if self.use_binned_dataset:
+            fold_index_list = [
+                get_labelled_fold_index(
+                    data_folder=self.config_dict['PATH_PARQUET_DATA'], 
+                    target_col=self.target_col_name, fold_=fold_
+                ) for fold_ in range(self.n_fold)
+            ]
+            binned_fold_path_list = self.prepare_binned_fold_list(fold_index_list)
+            binned_params = self._get_binned_dataset_params()
+        else:
+            feature_store = self.get_feature_store()
+            store_path = feature_store['store_path']
+            fold_index_list = [
+                get_store_fold_index(
+                    feature_store=feature_store, fold_=fold_, fold_code_dict=self.fold_code_dict
+                ) 
+                for fold_ in range(self.n_fold)
+            ]
+        
+        #spawn -> no openmp state inherited from the parent
+        with ProcessPoolExecutor(
+            max_workers=self.n_parallel_fold, mp_context=get_context('spawn')
+        ) as executor:
+            future_list = [
+                executor.submit(
+                    train_fold_worker,
+                    fold_=fold_, params_lgb=self._get_fold_params(), 
+                    log_evaluation=self.log_evaluation, experiment_path=self.experiment_path,
+                    feature_list=self.feature_list, categorical_col_list=self.categorical_col_list,
+                    train_index=train_index, test_index=test_index,
+                    store_path=store_path, 
+                    binned_fold_path=binned_fold_path_list[fold_], binned_params=binned_params
+                )
+                for fold_, (train_index, test_index) in enumerate(fold_index_list)
+            ]
             
-            assert len(
-                set(
-                    train_filtered.select('date').collect().to_series().to_list()
-                ).intersection(
-                    test_filtered.select('date').collect().to_series().to_list()
+            #result in fold order
+            for future in future_list:
+                model, progress = future.result()
+                self.model_list.append(model)
+                self.progress_list.append(progress)
+        
+    def get_fold_matrix(
+            self, fold_: int, binned_dataset: lgb.Dataset = None, feature_store: Dict[str, Any] = None
+        ) -> Tuple[lgb.Dataset, lgb.Dataset]:
+        if self.use_binned_dataset:
+            train_index, test_index = get_labelled_fold_index(
+                    data_folder=self.config_dict['PATH_PARQUET_DATA'], 
+                    target_col=self.target_col_name, fold_=fold_
                 )
-            ) == 0
             
-            train_rows = train_filtered.select(pl.count()).collect().item()
-            test_rows = test_filtered.select(pl.count()).collect().item()
+            print(f'{len(train_index)} train rows; {len(test_index)} test rows; {len(self.feature_list)} feature')
             
-            print(f'{train_rows} train rows; {test_rows} test rows; {len(self.feature_list)} feature')
+            #subset keep bins of the whole binned dataset
+            train_matrix = binned_dataset.subset(train_index)
+            test_matrix = binned_dataset.subset(test_index)
+        elif self.use_feature_store:
+            train_index, test_index = get_store_fold_index(
+                    feature_store=feature_store, fold_=fold_, fold_code_dict=self.fold_code_dict
+                )
             
-            assert self.target_col_name not in self.feature_list
+            print(f'{len(train_index)} train rows; {len(test_index)} test rows; {len(self.feature_list)} feature')
             
             train_matrix = lgb.Dataset(
-                train_filtered.select(self.feature_list).collect().to_pandas().to_numpy('float32'),
-                train_filtered.select(self.target_col_name).collect().to_pandas().to_numpy('float64').reshape((-1))
+                *load_store_view_list(feature_store, train_index),
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list
+            )
+            test_matrix = lgb.Dataset(
+                *load_store_view_list(feature_store, test_index),
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list
+            )
+        else:
+            train_data, test_data = self.load_fold(fold_=fold_)
+            
+            print(f'{train_data.height} train rows; {test_data.height} test rows; {len(self.feature_list)} feature')
+            
+            train_matrix = lgb.Dataset(
+                load_feature_matrix(train_data, self.feature_list, order='F'),
+                load_target_array(train_data, self.target_col_name),
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list
             )
             
             test_matrix = lgb.Dataset(
-                test_filtered.select(self.feature_list).collect().to_pandas().to_numpy('float32'),
-                test_filtered.select(self.target_col_name).collect().to_pandas().to_numpy('float64').reshape((-1))
+                load_feature_matrix(test_data, self.feature_list, order='F'),
+                load_target_array(test_data, self.target_col_name),
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list
             )
+            del train_data, test_data
+        
+        return train_matrix, test_matrix
 
-            print('Start training')
+    def _get_checkpoint_path(self) -> str:
+        return os.path.join(self.experiment_path, 'checkpoint')
+    
+    def save_checkpoint(self, model_list: list[lgb.Booster], progress_list: list) -> None:
+        #model of each fold at this round, then state which points to them.
+        #state is replaced last -> a killed run always leaves a complete checkpoint
+        checkpoint_path = self._get_checkpoint_path()
+        if not os.path.isdir(checkpoint_path):
+            os.makedirs(checkpoint_path)
+        
+        number_round = len(progress_list[0]['valid'][self.metric_eval])
+        for fold_, model in enumerate(model_list):
+            model.save_model(
+                os.path.join(checkpoint_path, f'lgb_{fold_}_{number_round}.txt')
+            )
+        
+        with open(os.path.join(checkpoint_path, 'state.pkl.tmp'), 'wb') as file:
+            pickle.dump(
+                {
+                    'number_round': number_round,
+                    'progress_list': progress_list,
+                    'feature_list': self.feature_list,
+                    'params_lgb': self.params_lgb
+                }, 
+                file
+            )
+        os.replace(
+            os.path.join(checkpoint_path, 'state.pkl.tmp'),
+            os.path.join(checkpoint_path, 'state.pkl')
+        )
+        
+        for old_model_path in glob(os.path.join(checkpoint_path, 'lgb_*.txt')):
+            if not old_model_path.endswith(f'_{number_round}.txt'):
+                os.remove(old_model_path)
+    
+    def load_checkpoint(self) -> dict[str, Any]:
+        #None when there is nothing to resume for the same feature and params
+        state_path = os.path.join(self._get_checkpoint_path(), 'state.pkl')
+        if not os.path.exists(state_path):
+            return None
+        
+        with open(state_path, 'rb') as file:
+            checkpoint = pickle.load(file)
+        
+        if (
+            (checkpoint['feature_list'] != self.feature_list) or
+            (checkpoint['params_lgb'] != self.params_lgb)
+        ):
+            print('Checkpoint of different feature or params, starting from scratch')
+            return None
+        
+        if self.use_binned_dataset:
+            #continued training scores the fold rows again, binary binned dataset has no raw rows
+            print('Checkpoint can\'t be resumed on binned dataset, starting from scratch')
+            return None
+        
+        return checkpoint
+    
+    def early_stopping_train(self, binned_dataset: lgb.Dataset = None, feature_store: Dict[str, Any] = None) -> None:
+        #every fold is boosted one round at a time -> all folds stop together
+        #when the cv average hasn't improved for early_stopping_round rounds
+        checkpoint = self.load_checkpoint()
+        fold_params = self._get_fold_params()
+        
+        model_list, progress_list = [], []
+        for fold_ in range(self.n_fold):
+            print(f'\n\nPreparing fold {fold_}\n\n\n')
+            
+            assert self.target_col_name not in self.feature_list
+            train_matrix, test_matrix = self.get_fold_matrix(
+                fold_=fold_, binned_dataset=binned_dataset, feature_store=feature_store
+            )
+            #first round, continued from checkpoint model if any
             model = lgb.train(
-                params=self.params_lgb,
+                params=fold_params,
                 train_set=train_matrix, 
-                feature_name=self.feature_list,
-                categorical_feature=self.categorical_col_list,
-                num_boost_round=self.params_lgb['n_round'],
+                num_boost_round=1,
+                init_model=(
+                    None if checkpoint is None 
+                    else os.path.join(
+                        self._get_checkpoint_path(), f'lgb_{fold_}_{checkpoint["number_round"]}.txt'
+                    )
+                ),
                 valid_sets=[test_matrix],
                 valid_names=['valid'],
-                callbacks=callbacks_list,
+                keep_training_booster=True
             )
-
+            model_list.append(model)
+            progress_list.append(
+                {'valid': {}} if checkpoint is None 
+                else checkpoint['progress_list'][fold_]
+            )
+            del train_matrix, test_matrix
+            _ = gc.collect()
+        
+        if checkpoint is not None:
+            print(f'Resuming from round {checkpoint["number_round"]}')
+        
+        print('Start training')
+        higher_better = None
+        while True:
+            for model, progress in zip(model_list, progress_list):
+                for _, metric_name, score, is_higher_better in model.eval_valid():
+                    progress['valid'].setdefault(metric_name, []).append(score)
+                    
+                    if metric_name == self.metric_eval:
+                        higher_better = is_higher_better
+            
+            if higher_better is None:
+                raise ValueError(
+                    f'metric_eval {self.metric_eval} is not a metric of the booster: '
+                    f'{list(progress_list[0]["valid"].keys())}'
+                )
+            
+            average_curve = np.mean(
+                [progress['valid'][self.metric_eval] for progress in progress_list], axis=0
+            )
+            number_round = average_curve.shape[0]
+            best_round = int(average_curve.argmax() if higher_better else average_curve.argmin())
+            
+            if (number_round % self.log_evaluation) == 0:
+                print(f'[{number_round}]\taverage valid {self.metric_eval}: {average_curve[-1]:.5f}')
+            
+            if (number_round % self.checkpoint_round) == 0:
+                self.save_checkpoint(model_list=model_list, progress_list=progress_list)
+            
+            if number_round - 1 - best_round >= self.early_stopping_round:
+                print(f'Early stopping at round {number_round}, best average round {best_round + 1}')
+                break
+            
+            if number_round >= self.params_lgb['n_round']:
+                break
+            
+            for model in model_list:
+                model.update()
+        
+        for fold_, model in enumerate(model_list):
             model.save_model(
                 os.path.join(
                     self.experiment_path,
                     f'lgb_{fold_}.txt'
                 ), importance_type='gain'
             )
+        
+        self.model_list = model_list
+        self.progress_list = progress_list
+        
+        #final models are saved -> checkpoint no longer needed
+        shutil.rmtree(self._get_checkpoint_path(), ignore_errors=True)
+    
+    def train(self) -> None:
+        
+        self._init_train()
+        
+        if self.n_parallel_fold > 1:
+            self.parallel_train()
+            return
+        
+        binned_dataset, feature_store = None, None
+        if self.use_binned_dataset:
+            binned_dataset = self.load_binned_dataset()
+        elif self.use_feature_store:
+            feature_store = self.get_feature_store()
+        
+        if self.early_stopping_round is not None:
+            self.early_stopping_train(binned_dataset=binned_dataset, feature_store=feature_store)
+            return
+        
+        for fold_ in range(self.n_fold):
+            print(f'\n\nStarting fold {fold_}\n\n\n')
+            
+            print('Collecting dataset')
+            assert self.target_col_name not in self.feature_list
+            
+            train_matrix, test_matrix = self.get_fold_matrix(
+                fold_=fold_, binned_dataset=binned_dataset, feature_store=feature_store
+            )
+
+            model, progress = fit_fold(
+                fold_=fold_, params_lgb=self._get_fold_params(), log_evaluation=self.log_evaluation,
+                experiment_path=self.experiment_path, train_matrix=train_matrix, test_matrix=test_matrix
+            )
 
             self.model_list.append(model)
             self.progress_list.append(progress)
@@ -124,25 +561,37 @@ class LgbmTrainer(LgbmInit):
 
     def all_data_train(self, num_round: int) -> None:
         
-        data = pl.scan_parquet(
-            os.path.join(
-                self.config_dict['PATH_PARQUET_DATA'],
-                'data.parquet'
+        if self.use_binned_dataset:
+            train_matrix = self.load_binned_dataset()
+        elif self.use_feature_store:
+            feature_store = self.get_feature_store()
+            #every labelled row -> memory map used without copy
+            train_matrix = lgb.Dataset(
+                feature_store['feature'],
+                feature_store['target'],
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list
+            )
+        else:
+            data = pl.scan_parquet(
+                os.path.join(
+                    self.config_dict['PATH_PARQUET_DATA'],
+                    'data.parquet'
+                )
+            ).filter(
+                (pl.col('target').is_not_null())
+            ).select(self.feature_list + [self.target_col_name]).collect()
+            train_matrix = lgb.Dataset(
+                load_feature_matrix(data, self.feature_list, order='F'),
+                load_target_array(data, self.target_col_name),
+                feature_name=self.feature_list,
+                categorical_feature=self.categorical_col_list
             )
-        ).filter(
-            (pl.col('target').is_not_null())
-        )
-        train_matrix = lgb.Dataset(
-            data.select(self.feature_list).collect().to_pandas().to_numpy('float32'),
-            data.select(self.target_col_name).collect().to_pandas().to_numpy('float64').reshape((-1))
-        )
         
         print('Start training model on all data with selected epoch')
         model = lgb.train(
             params=self.params_lgb,
             train_set=train_matrix, 
-            feature_name=self.feature_list,
-            categorical_feature=self.categorical_col_list,
             num_boost_round=num_round,
         )
 
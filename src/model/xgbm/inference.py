@@ -2,11 +2,12 @@ import numpy as np
 import polars as pl
 
 import xgboost as xgb
+from src.utils.matrix_utils import load_feature_matrix
 from src.model.xgbm.initialization import XgbInit
 
 class XgbInference(XgbInit):     
     def load_feature_data(self, data: pl.DataFrame) -> np.ndarray:
-        return data.select(self.feature_list).to_pandas().to_numpy(dtype='float32')
+        return load_feature_matrix(data, self.feature_list, order='C')
     
     def single_model_predict(self, test_data: pl.DataFrame) -> np.ndarray:        
         test_data = self.load_feature_data(test_data)
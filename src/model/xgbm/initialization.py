@@ -8,19 +8,23 @@ import xgboost as xgb
 
 from typing import Any, Union
 
+from src.utils.matrix_utils import load_fold_info
+
 class XgbInit():
     def __init__(self, 
             experiment_name:str, 
             params_xgb: dict[str, Any],
             metric_eval: str,
             config_dict: dict[str, Any], inference_setup: str=None,
-            log_evaluation:int =1, fold_name: str = 'fold_info', use_importance_filter: bool = False, number_importance_feature: int = None
+            log_evaluation:int =1, use_importance_filter: bool = False, number_importance_feature: int = None,
+            n_parallel_fold: int = 1, thread_budget: int = None,
+            use_feature_store: bool = False, matrix_setup: str = None
         ):
         if inference_setup is None:
             self.inference_setup = 'blend'
         else:
             if inference_setup not in ['single', 'blend']:
-                raise ValueError
+                raise ValueError(f'inference_setup must be single or blend, got {inference_setup}')
             else:
                 self.inference_setup = inference_setup
         
@@ -35,7 +39,10 @@ class XgbInit():
         self.n_fold: int = config_dict['N_FOLD']
         
         self.target_col_name: str = config_dict['TARGET_COL']
-        self.fold_name: str = fold_name
+        #fold column and code are read from the data manifest by load_fold_info
+        self.fold_name: str = None
+        self.fold_col_list: list[str] = None
+        self.fold_code_dict: dict[str, int] = None
         self.useless_col_list: list[str] = [
             'datetime', 'date', 'date_order_kfold',
             'data_block_id', 'prediction_unit_id',
@@ -43,7 +50,7 @@ class XgbInit():
         ]
         if use_importance_filter:    
             if number_importance_feature is None:
-                raise ValueError
+                raise ValueError('use_importance_filter needs number_importance_feature')
             
             print('Importing best feature from lgb experiment')
             with open('config/best_feature.txt', "r") as file:
@@ -60,6 +67,45 @@ class XgbInit():
             "is_consumption",
         ]
         self.log_evaluation: int = log_evaluation
+        #number of fold trained together and total thread used by them -> None every core
+        self.n_parallel_fold: int = n_parallel_fold
+        self.thread_budget: int = thread_budget
+        #read training matrix from the memory mapped feature store in PATH_PARQUET_DATA instead of data.parquet
+        self.use_feature_store: bool = use_feature_store
+        
+        #dmatrix: dense fold matrix in memory, quantile: QuantileDMatrix streamed from data.parquet,
+        #external_memory: DMatrix streamed from data.parquet with pages cached on disk
+        if matrix_setup is None:
+            self.matrix_setup: str = 'dmatrix'
+        else:
+            if matrix_setup not in ['dmatrix', 'quantile', 'external_memory']:
+                raise ValueError(
+                    f'matrix_setup must be dmatrix, quantile or external_memory, got {matrix_setup}'
+                )
+            
+            #streamed matrix read data.parquet fold by fold
+            if (matrix_setup != 'dmatrix') and (use_feature_store or (n_parallel_fold > 1)):
+                raise ValueError(
+                    f'matrix_setup {matrix_setup} streams data.parquet, '
+                    'it can\'t be used with use_feature_store or n_parallel_fold > 1'
+                )
+            
+            #adaptive leaf objective aren't supported by xgboost external memory
+            if (
+                (matrix_setup == 'external_memory') and 
+                (params_xgb.get('objective') in ['reg:absoluteerror', 'reg:quantileerror'])
+            ):
+                raise ValueError(
+                    f'matrix_setup external_memory doesn\'t support objective {params_xgb["objective"]}, use quantile'
+                )
+            
+            self.matrix_setup: str = matrix_setup
+
+        #feature store fold are pushed to a QuantileDMatrix
+        if (use_feature_store or (n_parallel_fold > 1)) and (params_xgb.get('tree_method', 'hist') != 'hist'):
+            raise ValueError(
+                f'use_feature_store and n_parallel_fold > 1 need tree_method hist, got {params_xgb["tree_method"]}'
+            )
         self.data: pl.LazyFrame = None
         self.params_xgb: dict[str, Any] = params_xgb
         
@@ -110,6 +156,17 @@ class XgbInit():
         if not os.path.isdir(self.experiment_path):
             os.makedirs(self.experiment_path)
 
+    def load_fold_info(self) -> None:
+        fold_info = load_fold_info(self.config_dict['PATH_PARQUET_DATA'])
+        if len(fold_info['fold_col_list']) != self.n_fold:
+            raise ValueError(
+                f'N_FOLD is {self.n_fold}, data has {len(fold_info["fold_col_list"])} fold'
+            )
+        
+        self.fold_name = fold_info['fold_name']
+        self.fold_col_list = fold_info['fold_col_list']
+        self.fold_code_dict = fold_info['fold_code_dict']
+
     def load_model(self) -> None: 
         self.load_used_feature()
         self.load_best_result()
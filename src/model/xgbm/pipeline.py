@@ -11,12 +11,16 @@ class XgbmPipeline(XgbTrainer, XgbExplainer, XgbInference):
             params_xgb: dict[str, Any],
             metric_eval: str,
             config_dict: dict[str, Any], inference_setup: str=None,
-            log_evaluation:int =1, fold_name: str = 'fold_info', use_importance_filter: bool = False, number_importance_feature: int = None
+            log_evaluation:int =1, use_importance_filter: bool = False, number_importance_feature: int = None,
+            n_parallel_fold: int = 1, thread_budget: int = None,
+            use_feature_store: bool = False, matrix_setup: str = None
         ):
         XgbInit.__init__(
             self, experiment_name=experiment_name, params_xgb=params_xgb,
             metric_eval=metric_eval, config_dict=config_dict, inference_setup=inference_setup,
-            log_evaluation=log_evaluation, fold_name=fold_name, use_importance_filter=use_importance_filter, number_importance_feature = number_importance_feature
+            log_evaluation=log_evaluation, use_importance_filter=use_importance_filter, number_importance_feature = number_importance_feature,
+            n_parallel_fold=n_parallel_fold, thread_budget=thread_budget,
+            use_feature_store=use_feature_store, matrix_setup=matrix_setup
         )
 
     def activate_inference(self) -> None:
@@ -1,12 +1,148 @@
 import os
 import gc
+import shutil
+import numpy as np
 import polars as pl
 import xgboost as xgb
+import pyarrow.dataset as ds
 
+from typing import Any, Callable, Dict, Tuple
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+
+from src.utils.matrix_utils import (
+    load_feature_matrix, load_target_array, get_candidate_feature_list,
+    prepare_feature_store, load_store_view_list, load_store_fold, get_store_fold_index
+)
 from src.model.xgbm.initialization import XgbInit
 
+class ParquetBatchIter(xgb.DataIter):
+    #labelled rows of one fold streamed from data.parquet record batch by record batch.
+    #fold and target filter are pushed down to the parquet reader
+    def __init__(self, 
+            data_path: str, feature_list: list[str], target_col: str, 
+            fold_col: str, fold_code: int, batch_size: int = 65_536, cache_prefix: str = None
+        ):
+        self.dataset: ds.Dataset = ds.dataset(data_path, format='parquet')
+        self.feature_list: list[str] = feature_list
+        self.target_col: str = target_col
+        self.fold_filter: ds.Expression = (
+            (ds.field(fold_col) == fold_code) &
+            (ds.field(target_col).is_valid())
+        )
+        self.batch_size: int = batch_size
+        self.batch_iter = None
+        
+        super().__init__(cache_prefix=cache_prefix)
+    
+    def reset(self) -> None:
+        self.batch_iter = None
+        
+    def next(self, input_data: Callable) -> int:
+        if self.batch_iter is None:
+            self.batch_iter = self.dataset.to_batches(
+                columns=self.feature_list + [self.target_col],
+                filter=self.fold_filter, batch_size=self.batch_size
+            )
+        
+        for batch in self.batch_iter:
+            if batch.num_rows == 0:
+                continue
+            
+            batch_data = pl.from_arrow(batch)
+            input_data(
+                data=load_feature_matrix(batch_data, self.feature_list),
+                label=load_target_array(batch_data, self.target_col),
+                feature_names=self.feature_list
+            )
+            return 1
+        
+        return 0
+
+class StoreRangeIter(xgb.DataIter):
+    #rows of one fold pushed to xgboost range by range from the feature store memory map
+    def __init__(self, feature_view_list: list[np.ndarray], target: np.ndarray, feature_list: list[str]):
+        self.feature_view_list: list[np.ndarray] = feature_view_list
+        self.target: np.ndarray = target
+        self.feature_list: list[str] = feature_list
+        self.position: int = 0
+        
+        super().__init__()
+    
+    def reset(self) -> None:
+        self.position = 0
+    
+    def next(self, input_data: Callable) -> int:
+        if self.position == len(self.feature_view_list):
+            return 0
+        
+        start_row = sum(view.shape[0] for view in self.feature_view_list[:self.position])
+        feature_view = self.feature_view_list[self.position]
+        input_data(
+            data=feature_view,
+            label=self.target[start_row:start_row + feature_view.shape[0]],
+            feature_names=self.feature_list
+        )
+        self.position += 1
+        return 1
+
+def load_store_dmatrix(
+        train_view: Tuple[list[np.ndarray], np.ndarray], test_view: Tuple[list[np.ndarray], np.ndarray],
+        feature_list: list[str], max_bin: int
+    ) -> Tuple[xgb.DMatrix, xgb.DMatrix]:
+    #only the quantized matrix is kept, valid share the cut of train
+    train_matrix = xgb.QuantileDMatrix(
+        StoreRangeIter(*train_view, feature_list=feature_list), max_bin=max_bin
+    )
+    test_matrix = xgb.QuantileDMatrix(
+        StoreRangeIter(*test_view, feature_list=feature_list), max_bin=max_bin, ref=train_matrix
+    )
+    return train_matrix, test_matrix
+
+def fit_fold(
+        fold_: int, params_xgb: dict[str, Any], log_evaluation: int, experiment_path: str,
+        train_matrix: xgb.DMatrix, test_matrix: xgb.DMatrix
+    ) -> Tuple[xgb.Booster, dict]:
+    progress = {}
+
+    print('Start training')
+    model = xgb.train(
+        params=params_xgb,
+        dtrain=train_matrix, 
+        num_boost_round=params_xgb['n_round'],
+        evals=[(test_matrix, 'valid')],
+        evals_result=progress, verbose_eval=log_evaluation
+    )
+
+    model.save_model(
+        os.path.join(
+            experiment_path,
+            f'xgb_{fold_}.json'
+        )
+    )
+    return model, progress
+
+def train_fold_worker(
+        fold_: int, params_xgb: dict[str, Any], log_evaluation: int, experiment_path: str,
+        feature_list: list[str], train_index: np.ndarray, test_index: np.ndarray,
+        store_path: str
+    ) -> Tuple[xgb.Booster, dict]:
+    #run inside a worker process: every worker maps the same feature store, fold rows are read from the map
+    print(f'Starting fold {fold_}: {len(train_index)} train rows; {len(test_index)} test rows')
+    fold_dict = load_store_fold(store_path=store_path, train_index=train_index, test_index=test_index)
+    
+    train_matrix, test_matrix = load_store_dmatrix(
+        train_view=fold_dict['train'], test_view=fold_dict['valid'],
+        feature_list=feature_list, max_bin=params_xgb.get('max_bin', 256)
+    )
+    return fit_fold(
+        fold_=fold_, params_xgb=params_xgb, log_evaluation=log_evaluation, 
+        experiment_path=experiment_path, train_matrix=train_matrix, test_matrix=test_matrix
+    )
+
 class XgbTrainer(XgbInit):
     def _init_train(self) -> None:
+        self.load_fold_info()
         data = pl.scan_parquet(
             os.path.join(
                 self.config_dict['PATH_PARQUET_DATA'],
@@ -15,10 +151,11 @@ class XgbTrainer(XgbInit):
         )
         if self.importance_feature_list is None:
             print('Using all feature')
-            self.feature_list = [
-                col for col in data.columns
-                if col not in self.useless_col_list + [self.fold_name, self.target_col_name]
-            ]
+            self.feature_list = get_candidate_feature_list(
+                column_list=data.columns, 
+                excluded_col_list=self.useless_col_list + [self.target_col_name], 
+                fold_col_list=self.fold_col_list
+            )
         else:
             print(f'Using top {len(self.importance_feature_list)} feature')
             self.feature_list = (
@@ -36,76 +173,194 @@ class XgbTrainer(XgbInit):
                 'data.parquet'
             )
         )
+        #fold membership is a UInt8 column -> filter on it is pushed down to the scan
         fold_data = fold_data.with_columns(
-            (
-                pl.col('fold_info').str.split(', ')
-                .list.get(fold_).alias('current_fold')
-            )
+            pl.col(self.fold_col_list[fold_]).alias('current_fold')
         )
         return fold_data
 
-    def train(self) -> None:
+    def load_fold(self, fold_: int) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        #single read of the fold, then split in memory
+        fold_data = self.access_fold(fold_=fold_).filter(
+            (pl.col('current_fold') != self.fold_code_dict['n']) &
+            (pl.col('target').is_not_null())
+        ).select(
+            self.feature_list + [self.target_col_name, 'date', 'current_fold']
+        ).collect()
         
-        self._init_train()
+        train_data = fold_data.filter(pl.col('current_fold') == self.fold_code_dict['t'])
+        test_data = fold_data.filter(pl.col('current_fold') == self.fold_code_dict['v'])
+        del fold_data
         
-        for fold_ in range(self.n_fold):
-            print(f'\n\nStarting fold {fold_}\n\n\n')
-            
-            progress = {}
+        assert len(
+            set(train_data['date'].unique().to_list()).intersection(
+                test_data['date'].unique().to_list()
+            )
+        ) == 0
+        
+        return train_data, test_data
 
-            print('Collecting dataset')
-            fold_data = self.access_fold(fold_=fold_)
-            
-            train_filtered = fold_data.filter(
-                (pl.col('current_fold') == 't') &
-                (pl.col('target').is_not_null())
+    def load_iter_matrix(self, fold_: int) -> Tuple[xgb.DMatrix, xgb.DMatrix]:
+        #fold streamed from data.parquet without the dense matrix in memory:
+        #quantile keeps only binned value, external_memory keeps pages on disk
+        data_path = os.path.join(
+            self.config_dict['PATH_PARQUET_DATA'],
+            'data.parquet'
+        )
+        fold_date = self.access_fold(fold_=fold_).filter(
+            (pl.col('current_fold') != self.fold_code_dict['n']) &
+            (pl.col('target').is_not_null())
+        ).select('date', 'current_fold').unique().collect()
+        
+        assert len(
+            set(fold_date.filter(pl.col('current_fold') == self.fold_code_dict['t'])['date'].to_list()).intersection(
+                fold_date.filter(pl.col('current_fold') == self.fold_code_dict['v'])['date'].to_list()
             )
-            test_filtered = fold_data.filter(
-                (pl.col('current_fold') == 'v') &
-                (pl.col('target').is_not_null())
+        ) == 0
+        
+        iter_dict = {
+            split: ParquetBatchIter(
+                data_path=data_path, feature_list=self.feature_list, target_col=self.target_col_name,
+                fold_col=self.fold_col_list[fold_], fold_code=self.fold_code_dict[fold_key],
+                cache_prefix=(
+                    os.path.join(self.experiment_path, 'xgb_cache', f'{split}_{fold_}')
+                    if self.matrix_setup == 'external_memory' else None
+                )
             )
+            for split, fold_key in [('train', 't'), ('valid', 'v')]
+        }
+        if self.matrix_setup == 'quantile':
+            max_bin = self.params_xgb.get('max_bin', 256)
             
-            assert len(
-                set(
-                    train_filtered.select('date').collect().to_series().to_list()
-                ).intersection(
-                    test_filtered.select('date').collect().to_series().to_list()
-                )
-            ) == 0
+            train_matrix = xgb.QuantileDMatrix(iter_dict['train'], max_bin=max_bin)
+            #valid use train quantile
+            test_matrix = xgb.QuantileDMatrix(iter_dict['valid'], ref=train_matrix, max_bin=max_bin)
+        else:
+            cache_path = os.path.join(self.experiment_path, 'xgb_cache')
+            if not os.path.isdir(cache_path):
+                os.makedirs(cache_path)
             
-            train_rows = train_filtered.select(pl.count()).collect().item()
-            test_rows = test_filtered.select(pl.count()).collect().item()
+            train_matrix = xgb.DMatrix(iter_dict['train'])
+            test_matrix = xgb.DMatrix(iter_dict['valid'])
+        
+        return train_matrix, test_matrix
+    
+    def get_feature_store(self) -> Dict[str, Any]:
+        return prepare_feature_store(
+            data_path=os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'data.parquet'
+            ),
+            store_root_path=os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'feature_store'
+            ),
+            feature_list=self.feature_list, target_col=self.target_col_name,
+            fold_col_list=self.fold_col_list,
+            date_col='date'
+        )
+    
+    def _get_fold_params(self) -> dict[str, Any]:
+        #split the thread budget between the folds trained together
+        if (self.thread_budget is None) and (self.n_parallel_fold == 1):
+            return self.params_xgb
+        
+        thread_budget = self.thread_budget if self.thread_budget is not None else os.cpu_count()
+        fold_params = {
+            param: value for param, value in self.params_xgb.items()
+            if param not in ['nthread', 'n_jobs']
+        }
+        fold_params['nthread'] = max(1, thread_budget // self.n_parallel_fold)
+        return fold_params
+    
+    def parallel_train(self) -> None:
+        #n_parallel_fold worker processes, each fold reads the shared feature store by memory map
+        print(f'Training {self.n_parallel_fold} fold together')
+        assert self.target_col_name not in self.feature_list
+        
+        feature_store = self.get_feature_store()
+        
+        #spawn -> no openmp state inherited from the parent
+        with ProcessPoolExecutor(
+            max_workers=self.n_parallel_fold, mp_context=get_context('spawn')
+        ) as executor:
+            future_list = []
+            for fold_ in range(self.n_fold):
+                train_index, test_index = get_store_fold_index(
+                    feature_store=feature_store, fold_=fold_, fold_code_dict=self.fold_code_dict
+                )
+                future_list.append(
+                    executor.submit(
+                        train_fold_worker,
+                        fold_=fold_, params_xgb=self._get_fold_params(), 
+                        log_evaluation=self.log_evaluation, experiment_path=self.experiment_path,
+                        feature_list=self.feature_list, 
+                        train_index=train_index, test_index=test_index,
+                        store_path=feature_store['store_path']
+                    )
+                )
             
-            print(f'{train_rows} train rows; {test_rows} test rows; {len(self.feature_list)} feature')
+            #result in fold order
+            for future in future_list:
+                model, progress = future.result()
+                self.model_list.append(model)
+                self.progress_list.append(progress)
+        
+    def train(self) -> None:
+        
+        self._init_train()
+        
+        if self.n_parallel_fold > 1:
+            self.parallel_train()
+            return
+        
+        if self.use_feature_store:
+            feature_store = self.get_feature_store()
+        
+        for fold_ in range(self.n_fold):
+            print(f'\n\nStarting fold {fold_}\n\n\n')
             
+            print('Collecting dataset')
             assert self.target_col_name not in self.feature_list
             
-            train_matrix = xgb.DMatrix(
-                train_filtered.select(self.feature_list).collect().to_pandas().to_numpy('float32'),
-                train_filtered.select(self.target_col_name).collect().to_pandas().to_numpy('float64').reshape((-1)),
-                feature_names=self.feature_list
-            )
-            
-            test_matrix = xgb.DMatrix(
-                test_filtered.select(self.feature_list).collect().to_pandas().to_numpy('float32'),
-                test_filtered.select(self.target_col_name).collect().to_pandas().to_numpy('float64').reshape((-1)),
-                feature_names=self.feature_list
-            )
-
-            print('Start training')
-            model = xgb.train(
-                params=self.params_xgb,
-                dtrain=train_matrix, 
-                num_boost_round=self.params_xgb['n_round'],
-                evals=[(test_matrix, 'valid')],
-                evals_result=progress, verbose_eval=self.log_evaluation
-            )
-
-            model.save_model(
-                os.path.join(
-                    self.experiment_path,
-                    f'xgb_{fold_}.json'
+            if self.matrix_setup in ['quantile', 'external_memory']:
+                train_matrix, test_matrix = self.load_iter_matrix(fold_=fold_)
+                
+                print(f'{train_matrix.num_row()} train rows; {test_matrix.num_row()} test rows; {len(self.feature_list)} feature')
+                
+            elif self.use_feature_store:
+                train_index, test_index = get_store_fold_index(
+                    feature_store=feature_store, fold_=fold_, fold_code_dict=self.fold_code_dict
+                )
+                
+                print(f'{len(train_index)} train rows; {len(test_index)} test rows; {len(self.feature_list)} feature')
+                
+                train_matrix, test_matrix = load_store_dmatrix(
+                    train_view=load_store_view_list(feature_store, train_index),
+                    test_view=load_store_view_list(feature_store, test_index),
+                    feature_list=self.feature_list, max_bin=self.params_xgb.get('max_bin', 256)
                 )
+            else:
+                train_data, test_data = self.load_fold(fold_=fold_)
+                
+                print(f'{train_data.height} train rows; {test_data.height} test rows; {len(self.feature_list)} feature')
+                
+                train_matrix = xgb.DMatrix(
+                    load_feature_matrix(train_data, self.feature_list, order='C'),
+                    load_target_array(train_data, self.target_col_name),
+                    feature_names=self.feature_list
+                )
+                
+                test_matrix = xgb.DMatrix(
+                    load_feature_matrix(test_data, self.feature_list, order='C'),
+                    load_target_array(test_data, self.target_col_name),
+                    feature_names=self.feature_list
+                )
+                del train_data, test_data
+
+            model, progress = fit_fold(
+                fold_=fold_, params_xgb=self._get_fold_params(), log_evaluation=self.log_evaluation,
+                experiment_path=self.experiment_path, train_matrix=train_matrix, test_matrix=test_matrix
             )
 
             self.model_list.append(model)
@@ -114,6 +369,9 @@ class XgbTrainer(XgbInit):
             del train_matrix, test_matrix
             
             _ = gc.collect()
+        
+        if self.matrix_setup == 'external_memory':
+            shutil.rmtree(os.path.join(self.experiment_path, 'xgb_cache'))
 
     def save_model(self)->None:
         self.save_pickle_model_list()
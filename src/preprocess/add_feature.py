@@ -3,45 +3,137 @@ import polars as pl
 import holidays
 
 from itertools import product
-from datetime import timedelta
+from datetime import date, timedelta
+from functools import lru_cache
 from typing import Dict, Union
 from src.preprocess.initialization import EnefitInit
+from src.preprocess.dense_lag import gather_lag, LagRingBuffer
+
+@lru_cache(maxsize=None)
+def get_estonian_holiday_list(min_year: int, max_year: int) -> list[date]:
+    #same years on every live iteration -> calendar built once
+    return list(
+        holidays.country_holidays('EE', years=range(min_year-1, max_year+1)).keys()
+    )
 
 class EnefitFeature(EnefitInit):
     def filter_dataset_inference(self) -> None:
         #used during inference to speedup calculation
-        #keep only what is needed
+        #keep only the source rows used by a feature of main_data.
+        #every feature is calculated over whole dates, so selecting whole dates
+        #gives exactly the same feature of the full history.
+        #starting dataset are sorted by time -> date range is sliced by binary search, then filtered
         assert self.inference
         
-        min_data_date, max_data_date = (
-            self.main_data['datetime'].min() - timedelta(days=self.target_n_lags+31), 
-            self.main_data['datetime'].max() + timedelta(days=self.target_n_lags+31)
-        )
-        self.client_data = self.client_data.filter(
-            (pl.col('date') >= min_data_date)&
-            (pl.col('date') <= max_data_date)
-        )
-        self.gas_data = self.gas_data.filter(
-            (pl.col('forecast_date') >= min_data_date)&
-            (pl.col('forecast_date') <= max_data_date)
-        )
-        self.electricity_data = self.electricity_data.filter(
-            (pl.col('forecast_date') >= min_data_date)&
-            (pl.col('forecast_date') <= max_data_date)
+        main_date_list = self.main_data['datetime'].dt.date().unique().sort().to_list()
+        if len(main_date_list) == 0:
+            #nothing to score -> every source is empty
+            for dataset_name in [
+                'client_data', 'gas_data', 'electricity_data', 'forecast_weather_data',
+                'historical_weather_data', 'target_data'
+            ]:
+                setattr(self, dataset_name, getattr(self, dataset_name).head(0))
+            return
+
+        min_date, max_date = main_date_list[0], main_date_list[-1]
+        
+        #client date is shifted by 2 days
+        self.client_data = self._slice_time_range(
+            data=self.client_data, dataset_name='client',
+            start=min_date - timedelta(days=2), end=max_date - timedelta(days=1)
+        ).filter(
+            pl.col('date').is_in(
+                [date_ - timedelta(days=2) for date_ in main_date_list]
+            )
         )
-        self.forecast_weather_data = self.forecast_weather_data.filter(
-            (pl.col('origin_datetime') >= min_data_date)&
-            (pl.col('origin_datetime') <= max_data_date)
+        #gas and electricity forecast date are shifted by 1 day
+        self.gas_data = self._slice_time_range(
+            data=self.gas_data, dataset_name='gas',
+            start=min_date - timedelta(days=1), end=max_date
+        ).filter(
+            pl.col('forecast_date').cast(pl.Date).is_in(
+                [date_ - timedelta(days=1) for date_ in main_date_list]
+            )
         )
-        self.historical_weather_data = self.historical_weather_data.filter(
-            (pl.col('datetime') >= min_data_date)&
-            (pl.col('datetime') <= max_data_date)
+        self.electricity_data = self._slice_time_range(
+            data=self.electricity_data, dataset_name='electricity',
+            start=min_date - timedelta(days=1), end=max_date
+        ).filter(
+            pl.col('forecast_date').dt.date().is_in(
+                [date_ - timedelta(days=1) for date_ in main_date_list]
+            )
         )
-        self.target_data = self.target_data.filter(
-            (pl.col('datetime') >= min_data_date)&
-            (pl.col('datetime') <= max_data_date)
+        #forecast is used the day after its origin
+        self.forecast_weather_data = self._slice_time_range(
+            data=self.forecast_weather_data, dataset_name='forecast_weather',
+            start=min_date - timedelta(days=1), end=max_date
+        ).filter(
+            pl.col('origin_datetime').cast(pl.Date).is_in(
+                [date_ - timedelta(days=1) for date_ in main_date_list]
+            )
         )
+        #same date rule of create_historical_weather_feature
+        self.historical_weather_data = self._slice_time_range(
+            data=self.historical_weather_data, dataset_name='historical_weather',
+            start=min_date - timedelta(days=2), end=max_date
+        ).filter(
+            (
+                pl.when(
+                    pl.col('datetime').dt.hour()<11
+                ).then(
+                    pl.col('datetime') + pl.duration(days=1)
+                ).otherwise(
+                    pl.col('datetime') + pl.duration(days=2)
+                )
+            ).cast(pl.Date).is_in(main_date_list)
+        )
+        #every day of target lag, unless read from the lag ring buffer
+        if self.target_lag_state is None:
+            self.target_data = self._slice_time_range(
+                data=self.target_data, dataset_name='target',
+                start=min_date - timedelta(days=self.target_n_lags), end=max_date - timedelta(days=1)
+            ).filter(
+                pl.col('datetime').dt.date().is_in(
+                    [
+                        date_ - timedelta(days=day_lag) 
+                        for date_ in main_date_list
+                        for day_lag in range(2, self.target_n_lags+1)
+                    ]
+                )
+            )
 
+    def _is_feature_required(self, col: str) -> bool:
+        return (
+            (self.required_feature_set is None) or 
+            (col in self.required_feature_set)
+        )
+    
+    def _filter_required_expr(self, expr_list: list[pl.Expr]) -> list[pl.Expr]:
+        #keep only expression whose output is needed
+        return [
+            expr for expr in expr_list
+            if self._is_feature_required(expr.meta.output_name())
+        ]
+    
+    def trace_required_feature(self) -> None:
+        #expand required feature with every column used to calculate them.
+        #feature created later in the pipeline are traced first
+        if self.required_feature_list is None:
+            self.required_feature_set = None
+            return
+        
+        required_feature_set = set(self.required_feature_list)
+        
+        for expr_list in (
+            [self._get_additional_feature_expr()] + 
+            self._get_target_stat_expr()[::-1]
+        ):
+            for expr in expr_list:
+                if expr.meta.output_name() in required_feature_set:
+                    required_feature_set.update(expr.meta.root_names())
+        
+        self.required_feature_set = required_feature_set
+        
     def copy_starting_dataset(self) -> None:
         #keep starting dataset without modification -> used during inference to update it
         self.client_data = self.starting_client_data
@@ -56,31 +148,35 @@ class EnefitFeature(EnefitInit):
         self.client_data = self.client_data.with_columns(
             #clean date column
             (pl.col("date") + pl.duration(days=2)).cast(pl.Date),
-            #eic count
-            (
-                pl.col('eic_count').mean()
-                .over(['date', 'product_type', 'county', 'is_business'])
-                .cast(pl.UInt16)
-                .alias('eic_count_mean_date')
-            ),
-            #installed capacity
-            (
-                pl.col('installed_capacity').mean()
-                .over(['date', 'product_type', 'county', 'is_business'])
-                .cast(pl.Float32)
-                .alias('installed_capacity_mean_date')
-            ),
-            #log 1p installed capacity
-            (
-                pl.col('installed_capacity').log1p()
-                .cast(pl.Float32)
-                .alias('installed_capacity_log1p')
-            ),
-            (
-                pl.col('installed_capacity').log1p().mean()
-                .over(['date', 'product_type', 'county', 'is_business'])
-                .cast(pl.Float32)
-                .alias('installed_capacity_log1p_mean_date')
+            *self._filter_required_expr(
+                [
+                    #eic count
+                    (
+                        pl.col('eic_count').mean()
+                        .over(['date', 'product_type', 'county', 'is_business'])
+                        .cast(pl.UInt16)
+                        .alias('eic_count_mean_date')
+                    ),
+                    #installed capacity
+                    (
+                        pl.col('installed_capacity').mean()
+                        .over(['date', 'product_type', 'county', 'is_business'])
+                        .cast(pl.Float32)
+                        .alias('installed_capacity_mean_date')
+                    ),
+                    #log 1p installed capacity
+                    (
+                        pl.col('installed_capacity').log1p()
+                        .cast(pl.Float32)
+                        .alias('installed_capacity_log1p')
+                    ),
+                    (
+                        pl.col('installed_capacity').log1p().mean()
+                        .over(['date', 'product_type', 'county', 'is_business'])
+                        .cast(pl.Float32)
+                        .alias('installed_capacity_log1p_mean_date')
+                    )
+                ]
             )
         )
         
@@ -91,16 +187,20 @@ class EnefitFeature(EnefitInit):
                 .dt.date().alias('date')
                 .cast(pl.Date)
             ),
-            (
-                (
-                    pl.col('lowest_price_per_mwh') + 
-                    pl.col('highest_price_per_mwh')
-                )/2
-            ).alias('mean_price_per_mwh').cast(pl.Float32),
-            (
-                pl.col('highest_price_per_mwh')-
-                pl.col('lowest_price_per_mwh')
-            ).alias('range_price_per_mwh').cast(pl.Float32)
+            *self._filter_required_expr(
+                [
+                    (
+                        (
+                            pl.col('lowest_price_per_mwh') + 
+                            pl.col('highest_price_per_mwh')
+                        )/2
+                    ).alias('mean_price_per_mwh').cast(pl.Float32),
+                    (
+                        pl.col('highest_price_per_mwh')-
+                        pl.col('lowest_price_per_mwh')
+                    ).alias('range_price_per_mwh').cast(pl.Float32)
+                ]
+            )
         )
         self.gas_data = self.gas_data.drop(['forecast_date'])
         
@@ -112,7 +212,7 @@ class EnefitFeature(EnefitInit):
         self.electricity_data = self.electricity_data.drop('forecast_date')
             
     def create_forecast_weather_feature(self) -> None:
-        min_hour, max_hour = 22, 45
+        min_hour, max_hour = self.forecast_min_hour, self.forecast_max_hour
         
         #filter hours ahead
         self.forecast_weather_data = self.forecast_weather_data.filter(
@@ -150,64 +250,118 @@ class EnefitFeature(EnefitInit):
             col: self.forecast_weather_data.select(col).dtypes[0]
             for col in training_variable
         }
-        combination_pivot_mean = list(product(training_variable, list(range(min_hour, max_hour+1))))
-        combination_pivot_other = combination_pivot_mean
-        
-        pivot_operator_mean = [
-            (
-                (
-                    pl.col(train_col)
-                    .filter(pl.col('hours_ahead') == hours)
-                ).mean()
-                .alias(f'{train_col}_hours_ahead_{hours}')
-                .cast(original_col_dict[train_col]) 
-            )
-            for train_col, hours in combination_pivot_mean
-        ]
-        pivot_operator_min = [
-            (
-                (
-                    pl.col(train_col)
-                    .filter(pl.col('hours_ahead') == hours)
-                ).min()
-                .alias(f'{train_col}_hours_ahead_{hours}_min')
-                .cast(original_col_dict[train_col]) 
+        #suffix of each statistic in the wide layout
+        stat_suffix_dict: Dict[str, str] = {
+            'mean': '', 'min': '_min', 'max': '_max', 'std': '_std'
+        }
+        #only statistic and hours ahead read by some feature
+        combination_pivot = [
+            (suffix, train_col, hours)
+            for suffix, train_col, hours in product(
+                stat_suffix_dict.values(), training_variable, list(range(min_hour, max_hour+1))
             )
-            for train_col, hours in combination_pivot_other
+            if self._is_feature_required(f'{train_col}_hours_ahead_{hours}{suffix}')
         ]
-        pivot_operator_max = [
-            (
-                (
-                    pl.col(train_col)
-                    .filter(pl.col('hours_ahead') == hours)
-                ).max()
-                .alias(f'{train_col}_hours_ahead_{hours}_max')
-                .cast(original_col_dict[train_col]) 
+        if len(combination_pivot) == 0:
+            #keep only key so merge is unchanged
+            self.forecast_weather_data = self.forecast_weather_data.select(index_variable).unique()
+            return
+        
+        stat_col_list = list(
+            dict.fromkeys(
+                f'{train_col}{suffix}'
+                for suffix, train_col, _ in combination_pivot
             )
-            for train_col, hours in combination_pivot_other
-        ]
-        pivot_operator_std = [
-            (
-                (
-                    pl.col(train_col)
-                    .filter(pl.col('hours_ahead') == hours)
-                ).std()
-                .alias(f'{train_col}_hours_ahead_{hours}_std')
-                .cast(original_col_dict[train_col]) 
+        )
+        self.forecast_weather_data = self.forecast_weather_data.filter(
+            pl.col('hours_ahead').is_in(
+                sorted(set(hours for _, _, hours in combination_pivot))
             )
-            for train_col, hours in combination_pivot_other
-        ]
-        pivot_operator_list = (
-            pivot_operator_mean + pivot_operator_min + 
-            pivot_operator_max + pivot_operator_std
         )
-        self.forecast_weather_data = (
+        
+        #every statistic is computed in a single group by on hours ahead
+        forecast_stat = (
             self.forecast_weather_data
-            .group_by(pl.col(index_variable))
+            .group_by(index_variable + ['hours_ahead'])
             .agg(
-                *pivot_operator_list
+                expr for expr in (
+                    [
+                        (
+                            pl.col(train_col).mean()
+                            .alias(f'{train_col}{stat_suffix_dict["mean"]}')
+                            .cast(original_col_dict[train_col])
+                        )
+                        for train_col in training_variable
+                    ] +
+                    [
+                        (
+                            pl.col(train_col).min()
+                            .alias(f'{train_col}{stat_suffix_dict["min"]}')
+                            .cast(original_col_dict[train_col])
+                        )
+                        for train_col in training_variable
+                    ] +
+                    [
+                        (
+                            pl.col(train_col).max()
+                            .alias(f'{train_col}{stat_suffix_dict["max"]}')
+                            .cast(original_col_dict[train_col])
+                        )
+                        for train_col in training_variable
+                    ] +
+                    [
+                        (
+                            pl.col(train_col).std()
+                            .alias(f'{train_col}{stat_suffix_dict["std"]}')
+                            .cast(original_col_dict[train_col])
+                        )
+                        for train_col in training_variable
+                    ]
+                )
+                if expr.meta.output_name() in stat_col_list
             )
         )
+        
+        #reshape to wide layout -> pivot is eager only
+        if not self.inference:
+            forecast_stat = forecast_stat.collect()
+
+        forecast_stat = forecast_stat.pivot(
+            values=stat_col_list, index=index_variable, 
+            columns='hours_ahead', aggregate_function=None
+        )
+        #pivot name is {value}_hours_ahead_{hour} or only {hour} with a single value
+        pivot_name_dict = {
+            (
+                f'{train_col}{suffix}_hours_ahead_{hours}'
+                if len(stat_col_list) > 1 else str(hours)
+            ): f'{train_col}_hours_ahead_{hours}{suffix}'
+            for suffix, train_col, hours in combination_pivot
+        }
+        pivot_col_set = set(forecast_stat.columns)
+        forecast_stat = forecast_stat.rename(
+            {
+                pivot_col: feature_col
+                for pivot_col, feature_col in pivot_name_dict.items()
+                if pivot_col in pivot_col_set
+            }
+        )
+        #hours without any forecast are added as missing
+        pivot_col_set = set(forecast_stat.columns)
+        self.forecast_weather_data = forecast_stat.select(
+            [pl.col(index_variable)] +
+            [
+                (
+                    pl.col(f'{train_col}_hours_ahead_{hours}{suffix}')
+                    if f'{train_col}_hours_ahead_{hours}{suffix}' in pivot_col_set
+                    else pl.lit(None, dtype=original_col_dict[train_col]).alias(f'{train_col}_hours_ahead_{hours}{suffix}')
+                )
+                for suffix, train_col, hours in combination_pivot
+            ]
+        )
+        
+        if not self.inference:
+            self.forecast_weather_data = self.forecast_weather_data.lazy()
 
     def create_historical_weather_feature(self) -> None:
         
@@ -265,292 +419,317 @@ class EnefitFeature(EnefitInit):
             self.historical_weather_data
             .group_by(pl.col(index_variable))
             .agg(
-                *[
-                    (
+                *self._filter_required_expr(
+                    [
                         (
-                        pl.col(train_col)
-                        ).mean()
-                        .alias(f'{train_col}_hours_ago_mean')
-                        .cast(original_col_dict[train_col])
-                    )
-                    for train_col in training_variable
-                ]
+                            (
+                            pl.col(train_col)
+                            ).mean()
+                            .alias(f'{train_col}_hours_ago_mean')
+                            .cast(original_col_dict[train_col])
+                        )
+                        for train_col in training_variable
+                    ]
+                )
             )
         )
 
-    def create_target_feature(self) -> None:
-        key_list: list[str] = ['county', 'is_business', 'product_type', 'is_consumption']
-
-        #this dataset is used to calculate the lag
-        target_data = self.target_data.with_columns(
-            pl.col('datetime').dt.date().alias('date').cast(pl.Date)
+    def _get_target_aggregation_dict(self) -> Dict[str, list[str]]:
+        #daily statistic by unit and hourly statistic leaving one key out
+        return {
+            'day': self.target_key_list + ['date'],
+            **{
+                col: [x for x in self.target_key_list if x != col] + ['datetime']
+                for col in self.target_key_list
+            }
+        }
+    
+    def _get_target_aggregation_col_list(self) -> list[str]:
+        #only aggregation whose lag is read by some feature
+        return [
+            f'{stat}_{name}_target'
+            for name in self._get_target_aggregation_dict().keys()
+            for stat in self.target_stat_list
+            if any(
+                self._is_feature_required(f'{stat}_{name}_target_lag_{day_lag}')
+                for day_lag in range(2, self.target_n_lags+1)
+            )
+        ]
+    
+    def _get_target_aggregation_data(self, target_data: pl.DataFrame) -> pl.DataFrame:
+        #target and every aggregation in a single pass over target_data.
+        #aggregation are broadcasted to each target row so they share the (unit x hour) layout of target
+        aggregation_col_list = self._get_target_aggregation_col_list()
+        return target_data.select(
+            self.target_key_list + ['datetime', 'target'] +
+            [
+                expr
+                for name, group_list in self._get_target_aggregation_dict().items()
+                for expr in [
+                    pl.col('target').mean().over(group_list).cast(pl.Float32).alias(f'avg_{name}_target'),
+                    pl.col('target').sum().over(group_list).cast(pl.Float32).alias(f'sum_{name}_target'),
+                    pl.col('target').min().over(group_list).cast(pl.Float32).alias(f'min_{name}_target'),
+                    pl.col('target').max().over(group_list).cast(pl.Float32).alias(f'max_{name}_target'),
+                    pl.col('target').std().over(group_list).cast(pl.Float32).alias(f'std_{name}_target'),
+                ]
+                if expr.meta.output_name() in aggregation_col_list
+            ]
         )
+    
+    def init_target_lag_state(self) -> None:
+        #live loop: target lag and aggregation kept by a ring buffer over the inference lookback,
+        #each new target date is aggregated once when it arrives
+        self.target_lag_state = LagRingBuffer(
+            key_list=self.target_key_list, time_col='datetime',
+            value_list=['target'] + self._get_target_aggregation_col_list(),
+            number_step=24*(self.inference_lookback_day+1), time_step=timedelta(hours=1)
+        )
+        if self.starting_target_data.height == 0:
+            return
         
-        min_datetime = self._collect_item_utils(
-            target_data.select('datetime').min()
-        )
-        max_datetime = self._collect_item_utils(
-            target_data.select('datetime').max()
+        max_date = self.starting_target_data['datetime'].max().date()
+        self.update_target_lag_state(
+            self._slice_time_range(
+                data=self.starting_target_data, dataset_name='target',
+                start=max_date - timedelta(days=self.inference_lookback_day), 
+                end=max_date + timedelta(days=1)
+            )
         )
+    
+    def update_target_lag_state(self, target_data_new: pl.DataFrame) -> None:
+        #aggregation need every row of a date -> whole dates of new target are read from the store
+        if target_data_new.height == 0:
+            return
+        
+        new_date_list = target_data_new['datetime'].dt.date().unique().sort().to_list()
+        target_data = self._slice_time_range(
+            data=self.starting_target_data, dataset_name='target',
+            start=new_date_list[0], end=new_date_list[-1] + timedelta(days=1)
+        ).with_columns(
+            pl.col('datetime').dt.date().alias('date').cast(pl.Date)
+        ).filter(pl.col('date').is_in(new_date_list))
         
-        #create join target df -> create more date so i can get all usable lag
-        #fix to main bugc
-        datetime_explosion = pl.datetime_range(
-            min_datetime - timedelta(days=self.target_n_lags+10),
-            max_datetime + timedelta(days=self.target_n_lags+10),
-            timedelta(hours=1), eager=True
-        ).to_frame('datetime')
+        self.target_lag_state.update(self._get_target_aggregation_data(target_data))
         
+    def create_target_feature(self) -> None:
+        lag_list: list[int] = list(range(2, self.target_n_lags+1))
+        aggregation_col_list: list[str] = self._get_target_aggregation_col_list()
+        
+        #this dataset is used to join to main_data -> only the key which need feature
+        target_feature = self.main_data.select(
+            self.target_key_list + ['datetime']
+        ).unique(maintain_order=True)
         if not self.inference:
-            datetime_explosion = datetime_explosion.lazy()
-            
-        #this dataset is used to join to main_data
-        target_feature = (
-            target_data.select(key_list).unique()
-            .join(
-                datetime_explosion, how='cross'
-            ).with_columns(
+            target_feature = target_feature.collect()
+
+        target_feature = target_feature.with_columns(
+            pl.col('datetime').dt.date().alias('date').cast(pl.Date)
+        )
+
+        if self.target_lag_state is None:
+            #this dataset is used to calculate the lag
+            target_data = self.target_data.with_columns(
                 pl.col('datetime').dt.date().alias('date').cast(pl.Date)
             )
-        )
-        # #add lag with aggregation on date
-        aggregation_by_date = (
-            target_data.select(
-                key_list + ['date', 'target']
-            ).group_by(key_list + ['date'])
-            .agg(
-                pl.col('target').mean().alias('avg_day_target').cast(pl.Float32),
-                pl.col('target').sum().alias('sum_day_target').cast(pl.Float32),
-                pl.col('target').min().alias('min_day_target').cast(pl.Float32),
-                pl.col('target').max().alias('max_day_target').cast(pl.Float32),
-                pl.col('target').std().alias('std_day_target').cast(pl.Float32),
+            if not self.inference:
+                target_data = target_data.collect()
+            
+            #read every lag of target and aggregation from a dense (unit x hour) array
+            lag_dict = gather_lag(
+                source=self._get_target_aggregation_data(target_data), query=target_feature,
+                key_list=self.target_key_list, time_col='datetime', 
+                value_list=['target'] + aggregation_col_list,
+                lag_list=[24*day_lag for day_lag in lag_list], time_step=timedelta(hours=1)
             )
-        )
-        
-        
-        aggregation_by_dict: Dict[str, Union[pl.LazyFrame, pl.DataFrame]] = {}
-        join_by_dict: Dict[str, list] = {}   
-        
-        for col in key_list:
-            other_key_list = [x for x in key_list if x != col]
-            aggregation_by_dict[col] = (
-                target_data.select(
-                    other_key_list + ['datetime', 'target']
-                ).group_by(other_key_list + ['datetime'])
-                .agg(
-                    pl.col('target').mean().alias(f'avg_{col}_target').cast(pl.Float32),
-                    pl.col('target').sum().alias(f'sum_{col}_target').cast(pl.Float32),
-                    pl.col('target').min().alias(f'min_{col}_target').cast(pl.Float32),
-                    pl.col('target').max().alias(f'max_{col}_target').cast(pl.Float32),
-                    pl.col('target').std().alias(f'std_{col}_target').cast(pl.Float32),
-                )
+        else:
+            lag_dict = self.target_lag_state.gather(
+                query=target_feature, value_list=['target'] + aggregation_col_list,
+                lag_list=[24*day_lag for day_lag in lag_list]
             )
-            join_by_dict[col] = other_key_list
+        
+        #keep only row with every target lag before calculating everything else
+        usable_row = np.all(
+            [~np.isnan(lag_dict['target'][24*day_lag]) for day_lag in lag_list], axis=0
+        )
+        target_feature = target_feature.filter(pl.Series(usable_row))
             
-        #add all lag information
-        for day_lag in range(2, self.target_n_lags+1):
-            #add normal value
-            target_feature = target_feature.join(
-                (
-                    target_data
-                    .select(key_list + ['datetime', 'target'])
-                    .with_columns(
-                        (pl.col("datetime") + pl.duration(days=day_lag)),
-                        (pl.col('target').log1p().cast(pl.Float32).alias(f'target_log1p_lag_{day_lag}'))
-                    )
-                    .rename({"target": f"target_lag_{day_lag}"})
-                ),
-                on = key_list + ['datetime'], how='left'
-            )
-
-            target_feature = target_feature.join(
-                aggregation_by_date.with_columns(
-                    pl.col("date") + pl.duration(days=day_lag)
-                ).rename(
-                    {
-                        'avg_day_target': f'avg_day_target_lag_{day_lag}',
-                        'sum_day_target': f'sum_day_target_lag_{day_lag}',
-                        'min_day_target': f'min_day_target_lag_{day_lag}',
-                        'max_day_target': f'max_day_target_lag_{day_lag}',
-                        'std_day_target': f'std_day_target_lag_{day_lag}',            
-                    }
-                ),
-                on = key_list + ['date'], how='left'
+        #add all lag information -> raw target lag is always needed to filter usable row
+        lag_feature_list: list[pl.Series] = []
+        for day_lag in lag_list:
+            target_lag = pl.Series(
+                f'target_lag_{day_lag}', 
+                lag_dict['target'][24*day_lag][usable_row], nan_to_null=True
             )
+            lag_feature_list.append(target_lag)
             
-            for col in key_list:
-                target_feature = target_feature.join(
-                    aggregation_by_dict[col].with_columns(
-                        pl.col("datetime") + pl.duration(days=day_lag)
-                    ).rename(
-                        {
-                            f'avg_{col}_target': f'avg_{col}_target_lag_{day_lag}',
-                            f'sum_{col}_target': f'sum_{col}_target_lag_{day_lag}',
-                            f'min_{col}_target': f'min_{col}_target_lag_{day_lag}',
-                            f'max_{col}_target': f'max_{col}_target_lag_{day_lag}',
-                            f'std_{col}_target': f'std_{col}_target_lag_{day_lag}',            
-                        }
-                    ),
-                    on = join_by_dict[col] + ['datetime'], how='left'
+            if self._is_feature_required(f'target_log1p_lag_{day_lag}'):
+                lag_feature_list.append(
+                    target_lag.log1p().cast(pl.Float32).alias(f'target_log1p_lag_{day_lag}')
                 )
 
-        target_lag_for_stats = [f"target_lag_{day_lag}" for day_lag in range(2, self.target_n_lags+1)]
-        target_lag_diff_col = [f'target_lag_{day_lag}_diff' for day_lag in range(2, self.target_n_lags)]
-        target_log1p_lag_diff_col = [f'target_log1p_lag_{day_lag}_diff' for day_lag in range(2, self.target_n_lags)]
+            lag_feature_list += [
+                pl.Series(
+                    f'{stat}_{name}_target_lag_{day_lag}', 
+                    lag_dict[f'{stat}_{name}_target'][24*day_lag][usable_row], nan_to_null=True
+                ).cast(pl.Float32)
+                for name in self._get_target_aggregation_dict().keys()
+                for stat in self.target_stat_list
+                if self._is_feature_required(f'{stat}_{name}_target_lag_{day_lag}')
+            ]
         
-        target_feature = target_feature.filter(
-            (
-                pl.any_horizontal(
-                    (
-                        pl.col(col).is_null() 
-                        for col in target_lag_for_stats
-                    )
-                ).not_()
-            )
-        )
+        target_feature = target_feature.with_columns(lag_feature_list)
 
+        if not self.inference:
+            target_feature = target_feature.lazy()
+        
         # #add mean lag over target
-        target_feature = (
-            target_feature
-            #target lag difference
-            .with_columns(
-                #diff
-                [
-                    (
-                        (pl.col(f'target_lag_{day_lag}') - pl.col(f'target_lag_{day_lag+1}'))
-                        .cast(pl.Float32).alias(f'target_lag_{day_lag}_diff')
-                    )
-                    for day_lag in range(2, self.target_n_lags)
-                ] +
-                #log diff
-                [
-                    (
-                        (pl.col(f'target_log1p_lag_{day_lag}') - pl.col(f'target_log1p_lag_{day_lag+1}'))
-                        .cast(pl.Float32).alias(f'target_log1p_lag_{day_lag}_diff')
-                    )
-                    for day_lag in range(2, self.target_n_lags)                    
-                ]
+        for target_stat_expr in self._get_target_stat_expr():
+            target_feature = target_feature.with_columns(
+                self._filter_required_expr(target_stat_expr)
             )
-            #all aggregation
-            .with_columns(
-                # #mean log1ptarget shift
-                (
-                    pl.concat_list(pl.col(target_log1p_lag_diff_col))
-                    .list.mean()
-                    .cast(pl.Float32).alias('target_log1p_mean_shift_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_log1p_lag_diff_col[:4]))
-                    .list.mean()
-                    .cast(pl.Float32).alias('target_log1p_mean_shift_all_lag_2_4')
-                ),
+        
+        self.target_data = target_feature.drop(
+            ['date']
+        )
 
-                # #mean target shift
-                (
-                    pl.concat_list(pl.col(target_lag_diff_col))
-                    .list.mean()
-                    .cast(pl.Float32).alias('target_mean_shift_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_lag_diff_col[:4]))
-                    .list.mean()
-                    .cast(pl.Float32).alias('target_mean_shift_all_lag_2_4')
-                ),
-                #target lag sum
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats))
-                    .list.sum().cast(pl.Float32).alias('target_sum_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats[:4]))
-                    .list.sum().cast(pl.Float32).alias('target_sum_all_lag_2_4')
-                ),
-                #target argmax sum
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats))
-                    .list.arg_max().cast(pl.UInt8).alias('target_argmax_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats[:4]))
-                    .list.arg_max().cast(pl.UInt8).alias('target_argmax_all_lag_2_4')
-                ),
-                #target argmin sum
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats))
-                    .list.arg_min().cast(pl.UInt8).alias('target_argmin_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats[:4]))
-                    .list.arg_min().cast(pl.UInt8).alias('target_argmin_all_lag_2_4')
-                ),
-                #target lag mean
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats))
-                    .list.mean().cast(pl.Float32).alias('target_mean_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats[:4]))
-                    .list.mean().cast(pl.Float32).alias('target_mean_all_lag_2_4')
-                ),
-                #target lag min
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats))
-                    .list.min().cast(pl.Float32).alias('target_min_all_lag')
-                ),
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats[:4]))
-                    .list.min().cast(pl.Float32).alias('target_min_all_lag_2_4')
-                ),
-                #target lag max
-                (
-                    pl.concat_list(pl.col(target_lag_for_stats))
-                    .list.max().cast(pl.Float32).alias('target_max_all_lag')
-                ),
+    def _get_target_stat_expr(self) -> list[list[pl.Expr]]:
+        #statistic over target lag. each list only uses column of the previous ones
+        target_lag_for_stats = [f"target_lag_{day_lag}" for day_lag in range(2, self.target_n_lags+1)]
+        target_lag_diff_col = [f'target_lag_{day_lag}_diff' for day_lag in range(2, self.target_n_lags)]
+        target_log1p_lag_diff_col = [f'target_log1p_lag_{day_lag}_diff' for day_lag in range(2, self.target_n_lags)]
+
+        target_diff_expr: list[pl.Expr] = (
+            #diff
+            [
                 (
-                    pl.concat_list(pl.col(target_lag_for_stats[:4]))
-                    .list.max().cast(pl.Float32).alias('target_max_all_lag_2_4')
+                    (pl.col(f'target_lag_{day_lag}') - pl.col(f'target_lag_{day_lag+1}'))
+                    .cast(pl.Float32).alias(f'target_lag_{day_lag}_diff')
                 )
-            )
-            #vs all aggregation
-            .with_columns(
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_mean_all_lag')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_mean_all')
-                ),
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_mean_all_lag_2_4')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_mean_all_lag_2_4')
-                ),
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_min_all_lag')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_min_all')
-                ),
+                for day_lag in range(2, self.target_n_lags)
+            ] +
+            #log diff
+            [
                 (
-                    (pl.col('target_lag_2')/(1+pl.col('target_min_all_lag_2_4')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_min_all_lag_2_4')
-                ),
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_max_all_lag')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_max_all')
-                ),
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_max_all_lag_2_4')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_max_all_lag_2_4')
-                ),
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_sum_all_lag')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_sum_all')
-                ),
-                (
-                    (pl.col('target_lag_2')/(1+pl.col('target_sum_all_lag_2_4')))
-                    .cast(pl.Float32).alias('target_lag_2_vs_sum_all_2_4')
+                    (pl.col(f'target_log1p_lag_{day_lag}') - pl.col(f'target_log1p_lag_{day_lag+1}'))
+                    .cast(pl.Float32).alias(f'target_log1p_lag_{day_lag}_diff')
                 )
-            )
-        )
-        
-        self.target_data = target_feature.drop(
-            ['target', 'date']
+                for day_lag in range(2, self.target_n_lags)                    
+            ]
         )
+        target_aggregation_expr: list[pl.Expr] = [
+            # #mean log1ptarget shift
+            (
+                pl.concat_list([pl.col(col) for col in target_log1p_lag_diff_col])
+                .list.mean()
+                .cast(pl.Float32).alias('target_log1p_mean_shift_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_log1p_lag_diff_col[:4]])
+                .list.mean()
+                .cast(pl.Float32).alias('target_log1p_mean_shift_all_lag_2_4')
+            ),
+
+            # #mean target shift
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_diff_col])
+                .list.mean()
+                .cast(pl.Float32).alias('target_mean_shift_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_diff_col[:4]])
+                .list.mean()
+                .cast(pl.Float32).alias('target_mean_shift_all_lag_2_4')
+            ),
+            #target lag sum
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats])
+                .list.sum().cast(pl.Float32).alias('target_sum_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats[:4]])
+                .list.sum().cast(pl.Float32).alias('target_sum_all_lag_2_4')
+            ),
+            #target argmax sum
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats])
+                .list.arg_max().cast(pl.UInt8).alias('target_argmax_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats[:4]])
+                .list.arg_max().cast(pl.UInt8).alias('target_argmax_all_lag_2_4')
+            ),
+            #target argmin sum
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats])
+                .list.arg_min().cast(pl.UInt8).alias('target_argmin_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats[:4]])
+                .list.arg_min().cast(pl.UInt8).alias('target_argmin_all_lag_2_4')
+            ),
+            #target lag mean
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats])
+                .list.mean().cast(pl.Float32).alias('target_mean_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats[:4]])
+                .list.mean().cast(pl.Float32).alias('target_mean_all_lag_2_4')
+            ),
+            #target lag min
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats])
+                .list.min().cast(pl.Float32).alias('target_min_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats[:4]])
+                .list.min().cast(pl.Float32).alias('target_min_all_lag_2_4')
+            ),
+            #target lag max
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats])
+                .list.max().cast(pl.Float32).alias('target_max_all_lag')
+            ),
+            (
+                pl.concat_list([pl.col(col) for col in target_lag_for_stats[:4]])
+                .list.max().cast(pl.Float32).alias('target_max_all_lag_2_4')
+            )
+        ]
+        target_vs_aggregation_expr: list[pl.Expr] = [
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_mean_all_lag')))
+                .cast(pl.Float32).alias('target_lag_2_vs_mean_all')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_mean_all_lag_2_4')))
+                .cast(pl.Float32).alias('target_lag_2_vs_mean_all_lag_2_4')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_min_all_lag')))
+                .cast(pl.Float32).alias('target_lag_2_vs_min_all')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_min_all_lag_2_4')))
+                .cast(pl.Float32).alias('target_lag_2_vs_min_all_lag_2_4')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_max_all_lag')))
+                .cast(pl.Float32).alias('target_lag_2_vs_max_all')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_max_all_lag_2_4')))
+                .cast(pl.Float32).alias('target_lag_2_vs_max_all_lag_2_4')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_sum_all_lag')))
+                .cast(pl.Float32).alias('target_lag_2_vs_sum_all')
+            ),
+            (
+                (pl.col('target_lag_2')/(1+pl.col('target_sum_all_lag_2_4')))
+                .cast(pl.Float32).alias('target_lag_2_vs_sum_all_2_4')
+            )
+        ]
+        return [target_diff_expr, target_aggregation_expr, target_vs_aggregation_expr]
 
     def create_train_feature(self) -> None:
         self.main_data = self.main_data.with_columns(
@@ -601,9 +780,7 @@ class EnefitFeature(EnefitInit):
             self.main_data.select('year').max()
         )
                 
-        estonian_holidays = list(
-            holidays.country_holidays('EE', years=range(min_year-1, max_year+1)).keys()
-        )
+        estonian_holidays = get_estonian_holiday_list(min_year=min_year, max_year=max_year)
 
         # add holiday as a dummy 0, 1 variable
         self.main_data = self.main_data.with_columns(
@@ -615,12 +792,7 @@ class EnefitFeature(EnefitInit):
             .cast(pl.UInt8).alias('holiday')
         )
         
-    def add_additional_feature(self) -> None:
-        if not self.inference:
-            n_rows_begin = self._collect_item_utils(
-                self.data.select(pl.count())
-            )
-        
+    def _get_additional_feature_expr(self) -> list[pl.Expr]:
         #production target ~ installed_capacity * surface_solar_radiation_downwards / (temperature + 273.15)
         #https://www.kaggle.com/competitions/predict-energy-behavior-of-prosumers/discussion/468654
         production_capacity_temperature_operator = [
@@ -631,7 +803,7 @@ class EnefitFeature(EnefitInit):
                 ) /
                 (pl.col(f'temperature_hours_ahead_{hour}') + pl.lit(273.15, dtype=pl.Float32))
             ).alias(f'production_capacity_temperature_{hour}')
-            for hour in range(22, 46)
+            for hour in range(self.forecast_min_hour, self.forecast_max_hour+1)
         ]
         #same but on installed_capacity log1p
         production_capacitylog1p_temperature_operator = [
@@ -642,7 +814,7 @@ class EnefitFeature(EnefitInit):
                 ) /
                 (pl.col(f'temperature_hours_ahead_{hour}') + pl.lit(273.15, dtype=pl.Float32))
             ).alias(f'production_capacity_log1p_temperature_{hour}')
-            for hour in range(22, 46)
+            for hour in range(self.forecast_min_hour, self.forecast_max_hour+1)
         ]
         target_vs_installed = [
             (
@@ -663,28 +835,41 @@ class EnefitFeature(EnefitInit):
         other = [
             (pl.col('installed_capacity')/(pl.lit(1) +pl.col('eic_count'))).alias('installed_vs_eic').cast(pl.Float32)
         ]
-        self.data = self.data.with_columns(
+        return (
             production_capacity_temperature_operator +
             production_capacitylog1p_temperature_operator +
             target_vs_installed +
             target_vs_eic +
             other
         )
-        
-        if not self.inference:
-            n_rows_end = self._collect_item_utils(
-                self.data.select(pl.count())
-            )
 
-            assert n_rows_begin == n_rows_end
+    def add_additional_feature(self) -> None:
+        self.data = self.data.with_columns(
+            self._filter_required_expr(
+                self._get_additional_feature_expr()
+            )
+        )
     
+    def _assert_unique_key(self, data: Union[pl.LazyFrame, pl.DataFrame], key_list: list[str], dataset_name: str) -> None:
+        #many to one join -> right dataset must be unique on join key
+        has_duplicate = self._collect_item_utils(
+            data.select(pl.struct(key_list).is_duplicated().any())
+        )
+        assert not has_duplicate, f'{dataset_name} is not unique on {key_list}'
+        
+    def check_unique_feature_key(self) -> None:
+        #every feature dataset unique on join key -> left join of merge_all can't add rows
+        for data, key_list, dataset_name in [
+            (self.client_data, ['county', 'is_business', 'product_type', 'date'], 'client'),
+            (self.electricity_data, ['datetime'], 'electricity'),
+            (self.gas_data, ['date'], 'gas'),
+            (self.forecast_weather_data, ['date', 'county'], 'forecast_weather'),
+            (self.historical_weather_data, ['date', 'county'], 'historical_weather'),
+            (self.target_data, ['datetime', 'county', 'is_business', 'product_type', 'is_consumption'], 'target')
+        ]:
+            self._assert_unique_key(data=data, key_list=key_list, dataset_name=dataset_name)
+        
     def merge_all(self) -> None:      
-        if not self.inference:
-      
-            n_rows_begin = self._collect_item_utils(
-                self.main_data.select(pl.count())
-            )
-
         #Merge all datasets
         #merge with client
         self.data = self.main_data.join(
@@ -720,10 +905,3 @@ class EnefitFeature(EnefitInit):
             self.target_data, how='left',
             on = ['datetime', 'county', 'is_business', 'product_type', 'is_consumption'],
         )
-
-        if not self.inference:
-            n_rows_end = self._collect_item_utils(
-                self.data.select(pl.count())
-            )
-
-            assert n_rows_begin == n_rows_end
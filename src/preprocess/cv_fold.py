@@ -1,45 +1,45 @@
-import pandas as pd
 import numpy as np
 
 import polars as pl
 
-from typing import Iterator, Tuple
+from typing import Tuple
 from src.preprocess.initialization import EnefitInit
 
 def get_time_series_cross_val_splits(
-    data: pd.DataFrame, time_col: str, num_fold: int, 
+    era: np.ndarray, num_fold: int, 
     embargo: int, min_time_to_use: int,
     percent_split: bool
-) -> Iterator[Tuple[list[int], list[int]]]:
+) -> Tuple[np.ndarray, list[Tuple[np.ndarray, np.ndarray]]]:
     #https://github.com/numerai/example-scripts/blob/495d3c13153c2068a87cf8c33196a787b2a0871f/utils.py#L79
+    #each test split is an interval of the sorted unique eras -> everything is searchsorted over them.
+    #return unique eras and for each fold the (train, test) mask over them
     
-    all_train_eras = data[time_col].unique()    
-    
-    if percent_split:
-        min_eras = all_train_eras.min()
-        max_eras = all_train_eras.max()
+    all_train_eras, era_size = np.unique(era, return_counts=True)
+    all_train_eras = all_train_eras.astype(np.int64)
+    number_eras = len(all_train_eras)
 
+    if percent_split:
         if min_time_to_use > 0:
             print('Min time to use not implemented for percent split')
-            
-        cumulative_size = data[[time_col]].sort_values(time_col).groupby(time_col).size()
-
-        cum_size_time = cumulative_size.cumsum()/cumulative_size.sum()
+        
+        cum_size_time = np.cumsum(era_size)/era_size.sum()
 
         percent_split = 1/num_fold
-        time_split = [cum_size_time[cum_size_time >= percent_split*i].index[0] for i in range(num_fold)]
-        max_eras = data[time_col].max()
+        #first era which reaches each percent of rows
+        time_split = np.searchsorted(
+            cum_size_time, [percent_split*i for i in range(num_fold)], side='left'
+        )
 
+        #boundaries are inclusive -> two consecutive test splits share the era in between
         test_splits = [
-            all_train_eras[
-                (all_train_eras >= (time_split[i] if i > 0 else min_eras)) &
-                (all_train_eras <= (time_split[i+1] if i < (num_fold - 1) else max_eras))
-            ] for i in range(num_fold)
+            (
+                time_split[i] if i > 0 else 0, 
+                (time_split[i+1] if i < (num_fold - 1) else number_eras - 1) + 1
+            )
+            for i in range(num_fold)
         ]
     
     else:
-        number_eras = len(all_train_eras)
-       
         #each test split has this length
         len_split = (
             number_eras - min_time_to_use
@@ -48,34 +48,32 @@ def get_time_series_cross_val_splits(
         #create kfold split by selecting also a min time to use --> first min_time_to_use won't be use for test split
         #fix the last test split to have all the last eras, in case the number of eras wasn't divisible by cv
         test_splits = [
-            all_train_eras[
-                (min_time_to_use + (i * len_split)):
-            (min_time_to_use + (i + 1) * len_split) if i < (num_fold - 1) else number_eras
-            ] for i in range(num_fold)
+            (
+                min_time_to_use + (i * len_split),
+                (min_time_to_use + (i + 1) * len_split) if i < (num_fold - 1) else number_eras
+            )
+            for i in range(num_fold)
         ]
 
-    train_splits = []
-    for test_split in test_splits:
+    era_position = np.arange(number_eras)
+    fold_mask_list = []
+    for test_start, test_end in test_splits:
+        test_mask = (era_position >= test_start) & (era_position < test_end)
         
         #get boundaries
-        test_split_min, test_split_max = int(np.min(test_split)), int(np.max(test_split))
+        test_split_min, test_split_max = all_train_eras[test_start], all_train_eras[test_end - 1]
 
-        # get all of the eras that aren't in the test split
-        train_split_not_embargoed = [e for e in all_train_eras if not (test_split_min <= int(e) <= test_split_max)]
-        
         # embargo the train split so we have no leakage.
-        train_split = [
-            e for e in train_split_not_embargoed if
-            abs(int(e) - test_split_max) > embargo and abs(int(e) - test_split_min) > embargo
-        ]
-        train_splits.append(train_split)
+        train_mask = (
+            (era_position < np.searchsorted(all_train_eras, test_split_min - embargo, side='left')) |
+            (era_position >= np.searchsorted(all_train_eras, test_split_max + embargo, side='right'))
+        )
+        fold_mask_list.append((train_mask, test_mask))
 
-    # convenient way to iterate over train and test splits
-    train_test_zip = zip(train_splits, test_splits)
-    return train_test_zip
+    return all_train_eras, fold_mask_list
 
 def get_fold(
-        data: pd.DataFrame, time_col: str,
+        era: np.ndarray,
         embargo: int, 
         num_fold: int, 
         min_time_to_use: int = 0, 
@@ -83,52 +81,56 @@ def get_fold(
         return_index: bool=True
     ) -> list[list[np.ndarray[int]]]:
     
-    fold_embargo_zip = get_time_series_cross_val_splits(
-        data=data, time_col=time_col, num_fold=num_fold, embargo=embargo, min_time_to_use=min_time_to_use,
+    all_train_eras, fold_mask_list = get_time_series_cross_val_splits(
+        era=era, num_fold=num_fold, embargo=embargo, min_time_to_use=min_time_to_use,
         percent_split=percent_split
     )
     if return_index:
+        #position of each row era inside unique eras
+        row_era_position = np.searchsorted(all_train_eras, era)
         fold_split = [
             [
-                np.where(data[time_col].isin(train_index))[0], 
-                np.where(data[time_col].isin(test_index))[0]
+                np.where(train_mask[row_era_position])[0], 
+                np.where(test_mask[row_era_position])[0]
             ]
-            for train_index, test_index in fold_embargo_zip
+            for train_mask, test_mask in fold_mask_list
         ]
     else:
         fold_split = [
-            [train_index, test_index]
-            for train_index, test_index in fold_embargo_zip
+            [all_train_eras[train_mask], all_train_eras[test_mask]]
+            for train_mask, test_mask in fold_mask_list
         ]
     return fold_split
 
 class EnefitFoldCreator(EnefitInit):
-    def create_fold(self):        
-        data_for_split = self.data.select([self.fold_time_col]).to_pandas() 
-        fold_split = get_fold(
-            data_for_split, time_col=self.fold_time_col, 
+    def create_fold_split(self, data: pl.DataFrame) -> None:
+        #split depends only on the era of each row
+        self.fold_split = get_fold(
+            data[self.fold_time_col].to_numpy(),
             embargo=self.embarko_skip,
             num_fold=self.n_folds, return_index=False
         )
-        self.data = self.data.with_columns(
+    
+    def add_fold_info(self, data: pl.DataFrame) -> pl.DataFrame:
+        #numeric code by fold -> reading a fold is a filter pushed down to the parquet scan
+        return data.with_columns(
             (
-                (
-                    pl.when(
-                        pl.col(self.fold_time_col)
-                        .is_in(fold_split[fold_][0])
-                    )
-                    .then(pl.lit('t'))
-                    .when(
-                        pl.col(self.fold_time_col)
-                        .is_in(fold_split[fold_][1])
-                    ).then(pl.lit('v')).otherwise(pl.lit('n'))
-                    .alias(f'fold_{fold_}')
+                pl.when(
+                    pl.col(self.fold_time_col)
+                    .is_in(self.fold_split[fold_][0])
+                )
+                .then(pl.lit(self.fold_code_dict['t'], dtype=pl.UInt8))
+                .when(
+                    pl.col(self.fold_time_col)
+                    .is_in(self.fold_split[fold_][1])
                 )
-                for fold_ in range(self.n_folds)
+                .then(pl.lit(self.fold_code_dict['v'], dtype=pl.UInt8))
+                .otherwise(pl.lit(self.fold_code_dict['n'], dtype=pl.UInt8))
+                .alias(f'{self.fold_name}_{fold_}')
             )
-        ).with_columns(
-            pl.concat_str(
-                [f'fold_{x}' for x in range(self.n_folds)],
-                separator=', '
-            ).alias('fold_info')
-        ).drop([f'fold_{x}' for x in range(self.n_folds)])
+            for fold_ in range(self.n_folds)
+        )
+
+    def create_fold(self):
+        self.create_fold_split(self.data)
+        self.data = self.add_fold_info(self.data)
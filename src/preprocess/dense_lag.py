@@ -0,0 +1,174 @@
+import numpy as np
+import polars as pl
+
+from datetime import timedelta
+from typing import Dict
+
+def get_time_index(data: pl.DataFrame, time_col: str, time_step: timedelta) -> np.ndarray:
+    #integer position of each row over a regular time grid
+    time_step_us = time_step // timedelta(microseconds=1)
+    return (
+        data[time_col].cast(pl.Datetime('us')).cast(pl.Int64)
+        // time_step_us
+    ).to_numpy()
+
+def get_key_index(source: pl.DataFrame, query: pl.DataFrame, key_list: list[str]) -> tuple[np.ndarray, np.ndarray, int]:
+    #dense id of every key combination of source, -1 for query key not in source
+    key_index = source.select(key_list).unique().with_row_count('key_index')
+
+    source_key = source.select(key_list).join(
+        key_index, on=key_list, how='left'
+    )['key_index'].cast(pl.Int64).to_numpy()
+    query_key = query.select(key_list).join(
+        key_index, on=key_list, how='left'
+    )['key_index'].cast(pl.Int64).fill_null(-1).to_numpy()
+
+    return source_key, query_key, key_index.height
+
+def gather_lag(
+        source: pl.DataFrame, query: pl.DataFrame,
+        key_list: list[str], time_col: str, value_list: list[str],
+        lag_list: list[int], time_step: timedelta
+    ) -> Dict[str, Dict[int, np.ndarray]]:
+    #lay each value of source as a dense (key x time) array,
+    #then read it for every query row shifted back by lag time step.
+    #missing source cell or null value gives nan
+
+    if source.height == 0:
+        return {
+            value: {
+                lag: np.full(query.height, np.nan, dtype=source[value].to_numpy().dtype)
+                for lag in lag_list
+            }
+            for value in value_list
+        }
+
+    source_key, query_key, number_key = get_key_index(
+        source=source, query=query, key_list=key_list
+    )
+    source_step = get_time_index(source, time_col=time_col, time_step=time_step)
+    query_step = get_time_index(query, time_col=time_col, time_step=time_step)
+
+    min_step = source_step.min()
+    number_step = source_step.max() - min_step + 1
+
+    source_step = source_step - min_step
+    query_step = query_step - min_step
+
+    result: Dict[str, Dict[int, np.ndarray]] = {}
+    for value in value_list:
+        source_value = source[value].to_numpy()
+
+        dense_value = np.full((number_key, number_step), np.nan, dtype=source_value.dtype)
+        dense_value[source_key, source_step] = source_value
+
+        result[value] = {}
+        for lag in lag_list:
+            lag_step = query_step - lag
+            valid_position = (query_key >= 0) & (lag_step >= 0) & (lag_step < number_step)
+
+            lag_value = np.full(query.height, np.nan, dtype=source_value.dtype)
+            lag_value[valid_position] = dense_value[
+                query_key[valid_position], lag_step[valid_position]
+            ]
+            result[value][lag] = lag_value
+
+    return result
+
+class LagRingBuffer():
+    #last number_step time steps of each value by key, kept across calls of the live loop.
+    #time step t is stored in slot t % number_step, slot_step tells which time step a slot holds
+    def __init__(
+            self, key_list: list[str], time_col: str, value_list: list[str],
+            number_step: int, time_step: timedelta
+        ):
+        self.key_list: list[str] = key_list
+        self.time_col: str = time_col
+        self.value_list: list[str] = value_list
+        self.number_step: int = number_step
+        self.time_step: timedelta = time_step
+        
+        self.key_data: pl.DataFrame = None
+        self.slot_step: np.ndarray = np.full(number_step, -1, dtype='int64')
+        self.value_dict: Dict[str, np.ndarray] = None
+    
+    def _get_key_index(self, data: pl.DataFrame) -> np.ndarray:
+        return data.select(self.key_list).join(
+            self.key_data, on=self.key_list, how='left'
+        )['key_index'].cast(pl.Int64).fill_null(-1).to_numpy()
+    
+    def _add_key(self, source: pl.DataFrame) -> None:
+        #new key get a new row of missing value
+        new_key = source.select(self.key_list).unique(maintain_order=True)
+        if self.key_data is not None:
+            new_key = new_key.join(self.key_data, on=self.key_list, how='anti')
+            if new_key.height == 0:
+                return
+        
+        number_key = 0 if self.key_data is None else self.key_data.height
+        new_key = new_key.with_columns(
+            pl.int_range(number_key, number_key + new_key.height, dtype=pl.UInt32).alias('key_index')
+        )
+        self.key_data = new_key if self.key_data is None else pl.concat([self.key_data, new_key])
+        
+        if self.value_dict is None:
+            self.value_dict = {
+                value: np.full((0, self.number_step), np.nan, dtype=source[value].to_numpy().dtype)
+                for value in self.value_list
+            }
+        self.value_dict = {
+            value: np.concatenate(
+                [dense_value, np.full((new_key.height, self.number_step), np.nan, dtype=dense_value.dtype)]
+            )
+            for value, dense_value in self.value_dict.items()
+        }
+    
+    def update(self, source: pl.DataFrame) -> None:
+        #every row of source written on its (key, time step). 
+        #a slot holding an older time step is cleared before, row older than the slot are dropped
+        if source.height == 0:
+            return
+        
+        self._add_key(source)
+        source_key = self._get_key_index(source)
+        source_step = get_time_index(source, time_col=self.time_col, time_step=self.time_step)
+        
+        for step in np.unique(source_step):
+            slot = step % self.number_step
+            if step > self.slot_step[slot]:
+                for dense_value in self.value_dict.values():
+                    dense_value[:, slot] = np.nan
+                self.slot_step[slot] = step
+        
+        source_slot = source_step % self.number_step
+        valid_position = self.slot_step[source_slot] == source_step
+        for value, dense_value in self.value_dict.items():
+            dense_value[source_key[valid_position], source_slot[valid_position]] = (
+                source[value].to_numpy()[valid_position]
+            )
+    
+    def gather(self, query: pl.DataFrame, value_list: list[str], lag_list: list[int]) -> Dict[str, Dict[int, np.ndarray]]:
+        #same output of gather_lag over the time steps held by the buffer
+        if self.key_data is None:
+            raise ValueError('LagRingBuffer.gather called before any update')
+        
+        query_key = self._get_key_index(query)
+        query_step = get_time_index(query, time_col=self.time_col, time_step=self.time_step)
+        
+        result: Dict[str, Dict[int, np.ndarray]] = {}
+        for value in value_list:
+            dense_value = self.value_dict[value]
+            
+            result[value] = {}
+            for lag in lag_list:
+                lag_step = query_step - lag
+                lag_slot = lag_step % self.number_step
+                valid_position = (query_key >= 0) & (self.slot_step[lag_slot] == lag_step)
+                
+                lag_value = np.full(query.height, np.nan, dtype=dense_value.dtype)
+                lag_value[valid_position] = dense_value[
+                    query_key[valid_position], lag_slot[valid_position]
+                ]
+                result[value][lag] = lag_value
+        
+        return result
@@ -1,24 +1,46 @@
 import os
+import json
+import hashlib
 import polars as pl
 import pandas as pd
 
-from typing import Dict, OrderedDict, List
+from glob import glob
+from datetime import datetime, timedelta
+
+from typing import Dict, List, Union
 from src.preprocess.initialization import EnefitInit
 
 class EnefitImport(EnefitInit):    
-    def clean_date_columns(self, dataset: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
-        for col in columns:
+    def _cast_new_date(self, data: pl.Series, dtype: pl.PolarsDataType) -> pl.Series:
+        if data.dtype == pl.Utf8:
             #datetime in int format ...
-            if all(
+            if data.str.contains(r'^\d+$').all():
+                data = data.cast(pl.Int64)
+            else:
+                data = data.str.to_datetime()
+
+        if data.dtype.is_integer():
+            #... is a nanosecond timestamp
+            data = data.cast(pl.Datetime('ns'))
+        
+        return data.cast(dtype)
+    
+    def _pandas_to_polars(self, data: pd.DataFrame, dataset_name: str) -> pl.DataFrame:
+        #single arrow conversion of used column then cast to declared schema
+        schema = self.starting_dataset_schema_dict[dataset_name]
+        data = pl.from_pandas(data[list(schema.keys())])
+
+        return pl.DataFrame(
+            [
                 (
-                    dataset[col] == 
-                    dataset[col].astype(int).astype(str)
+                    self._cast_new_date(data=data[col], dtype=dtype)
+                    if dtype.is_temporal()
+                    else data[col].cast(dtype)
                 )
-            ):
-                dataset[col] = dataset[col].astype(int)
+                for col, dtype in schema.items()
+            ]
+        )
         
-        return dataset
-    
     def set_type_new_data(
             self,
             client_data_new: pd.DataFrame,
@@ -28,64 +50,20 @@ class EnefitImport(EnefitInit):
             historical_weather_data_new: pd.DataFrame,
             target_data_new: pd.DataFrame,
             test_data: pd.DataFrame
-    ) -> List[pd.DataFrame]:
+    ) -> List[pl.DataFrame]:
         
-        test_data = self.clean_date_columns(dataset=test_data, columns=['prediction_datetime'])
-        target_data_new = self.clean_date_columns(dataset=target_data_new, columns=['datetime'])
-        client_data_new = self.clean_date_columns(dataset=client_data_new, columns=['date'])
-        historical_weather_data_new = self.clean_date_columns(dataset=historical_weather_data_new, columns=['datetime'])
-        forecast_weather_data_new = self.clean_date_columns(dataset=forecast_weather_data_new, columns=['origin_datetime', 'forecast_datetime'])
-        electricity_data_new = self.clean_date_columns(dataset=electricity_data_new, columns=['origin_date', 'forecast_date'])
-        gas_data_new = self.clean_date_columns(dataset=gas_data_new, columns=['origin_date', 'forecast_date'])
-
-        #TEST
-        test_data = test_data.astype(self.pandas_dataset_schema_dict['test'])
-        test_data['prediction_datetime'] = pd.to_datetime(test_data['prediction_datetime'])
         test_data = test_data.rename(
             columns={"prediction_datetime": "datetime"}
         )
-        
-        #CLIENT
-        client_data_new = client_data_new.astype(self.pandas_dataset_schema_dict['client'])
-        client_data_new['date'] = pd.to_datetime(client_data_new['date'])
-        
-        #GAS
-        gas_data_new = gas_data_new.astype(self.pandas_dataset_schema_dict['gas'])
-        
-        gas_data_new['origin_date'] = pd.to_datetime(gas_data_new['origin_date'])
-        gas_data_new['forecast_date'] = pd.to_datetime(gas_data_new['forecast_date'])
-
-        #ELECTRICITY
-        electricity_data_new = electricity_data_new.astype(self.pandas_dataset_schema_dict['electricity'])
-        electricity_data_new['origin_date'] = pd.to_datetime(electricity_data_new['origin_date'])
-        electricity_data_new['forecast_date'] = pd.to_datetime(electricity_data_new['forecast_date'])
-
-        #FORECAST WEATHER
-        forecast_weather_data_new = forecast_weather_data_new.astype(
-            self.pandas_dataset_schema_dict['forecast_weather']
-        )
-        forecast_weather_data_new['origin_datetime'] = pd.to_datetime(forecast_weather_data_new['origin_datetime'])
-        forecast_weather_data_new['forecast_datetime'] = pd.to_datetime(forecast_weather_data_new['forecast_datetime'])
-       
-        #HISTORICAL WEATHER
-        historical_weather_data_new = historical_weather_data_new.astype(
-            self.pandas_dataset_schema_dict['historical_weather']
-        )
-        historical_weather_data_new['datetime'] = pd.to_datetime(historical_weather_data_new['datetime'])
-
-        #TARGE
-        target_data_new = target_data_new.astype(
-            self.pandas_dataset_schema_dict['target']
-        )
-        target_data_new['datetime'] = pd.to_datetime(target_data_new['datetime'])
         return (
-            client_data_new,
-            gas_data_new,
-            electricity_data_new,
-            forecast_weather_data_new,
-            historical_weather_data_new,
-            target_data_new,
-            test_data
+            self._pandas_to_polars(client_data_new, 'client'),
+            self._pandas_to_polars(gas_data_new, 'gas'),
+            self._pandas_to_polars(electricity_data_new, 'electricity'),
+            self._pandas_to_polars(forecast_weather_data_new, 'forecast_weather'),
+            self._pandas_to_polars(historical_weather_data_new, 'historical_weather'),
+            self._pandas_to_polars(target_data_new, 'target'),
+            #before inference test data is used as training data
+            self._pandas_to_polars(test_data, 'test' if self.inference else 'train')
         )
         
     def update_with_new_data(
@@ -117,45 +95,19 @@ class EnefitImport(EnefitInit):
             target_data_new,
             test_data
         )
-        test_data = test_data.rename(
-            columns={"prediction_datetime": "datetime"}
-        )
-        client_data_new = pl.from_pandas(
-            client_data_new[self.starting_dataset_column_dict['client']], 
-            schema_overrides=self.starting_dataset_schema_dict['client']
-        )
-        gas_data_new = pl.from_pandas(
-            gas_data_new[self.starting_dataset_column_dict['gas']],
-            schema_overrides=self.starting_dataset_schema_dict['gas'],
-        )
-        electricity_data_new = pl.from_pandas(
-            electricity_data_new[self.starting_dataset_column_dict['electricity']],
-            schema_overrides=self.starting_dataset_schema_dict['electricity'],
-        )
-        forecast_weather_data_new = pl.from_pandas(
-            forecast_weather_data_new[self.starting_dataset_column_dict['forecast_weather']],
-            schema_overrides=self.starting_dataset_schema_dict['forecast_weather'],
-        )
-        historical_weather_data_new = pl.from_pandas(
-            historical_weather_data_new[self.starting_dataset_column_dict['historical_weather']],
-            schema_overrides=self.starting_dataset_schema_dict['historical_weather'],
-        )
-        target_data_new = pl.from_pandas(
-            target_data_new[self.starting_dataset_column_dict['target']], 
-            schema_overrides=self.starting_dataset_schema_dict['target']
-        )
-
         if self.inference:
-            test_data = pl.from_pandas(
-                test_data[self.starting_dataset_column_dict['test']], 
-                schema_overrides=self.starting_dataset_schema_dict['train']
-            )
             self.main_data = test_data
         else:
-            test_data = pl.from_pandas(
-                test_data[self.starting_dataset_column_dict['train']], 
-                schema_overrides=self.starting_dataset_schema_dict['train']
-            )
+            #appended batch are small -> content hash is the fingerprint of feature cache input
+            for dataset_name, new_data in [
+                ('client', client_data_new), ('gas', gas_data_new), 
+                ('electricity', electricity_data_new), ('forecast_weather', forecast_weather_data_new),
+                ('historical_weather', historical_weather_data_new), ('target', target_data_new),
+                ('train', test_data)
+            ]:
+                self.appended_fingerprint_dict[dataset_name].append(
+                    list(new_data.select(pl.count(), pl.all().hash(seed=0).sum()).row(0))
+                )
             (
                 client_data_new,
                 gas_data_new,
@@ -173,215 +125,249 @@ class EnefitImport(EnefitInit):
                 target_data_new.lazy(),
                 test_data.lazy()
             )
-            self.main_data = pl.concat(
-                [self.main_data, test_data]
-            ).unique(
-                [
-                    "county", "is_business", "product_type",
-                    "is_consumption", "datetime"
-                ]
+            self.main_data = self._append_new_data(
+                data=self.main_data, new_data=test_data, dataset_name='train'
             )
-        self.starting_client_data = pl.concat(
-            [self.starting_client_data, client_data_new]
-        ).unique(
-            ["date", "county", "is_business", "product_type"]
+        self.starting_client_data = self._append_new_data(
+            data=self.starting_client_data, new_data=client_data_new, 
+            dataset_name='client'
+        )
+        self.starting_gas_data = self._append_new_data(
+            data=self.starting_gas_data, new_data=gas_data_new, 
+            dataset_name='gas'
+        )
+        self.starting_electricity_data = self._append_new_data(
+            data=self.starting_electricity_data, new_data=electricity_data_new, 
+            dataset_name='electricity'
         )
-        self.starting_gas_data = pl.concat(
-            [self.starting_gas_data, gas_data_new]
-        ).unique(
-            ["forecast_date"]
+        self.starting_forecast_weather_data = self._append_new_data(
+            data=self.starting_forecast_weather_data, new_data=forecast_weather_data_new, 
+            dataset_name='forecast_weather'
         )
-        self.starting_electricity_data = pl.concat(
-            [self.starting_electricity_data, electricity_data_new]
-        ).unique(["forecast_date"])
+        self.starting_historical_weather_data = self._append_new_data(
+            data=self.starting_historical_weather_data, new_data=historical_weather_data_new, 
+            dataset_name='historical_weather'
+        )
+        self.starting_target_data = self._append_new_data(
+            data=self.starting_target_data, new_data=target_data_new, 
+            dataset_name='target'
+        )
+        if self.target_lag_state is not None:
+            self.update_target_lag_state(target_data_new)
         
-        self.starting_forecast_weather_data = pl.concat(
-            [self.starting_forecast_weather_data, forecast_weather_data_new]
-        ).unique(["origin_datetime", "latitude", "longitude", "hours_ahead"])
+        if self.inference:
+            self.evict_starting_dataset()
+
+    def _evict_dataset(self, data: pl.DataFrame, dataset_name: str, min_datetime: datetime) -> pl.DataFrame:
+        time_col = self.starting_dataset_key_dict[dataset_name][0]
         
-        self.starting_historical_weather_data = pl.concat(
-            [self.starting_historical_weather_data, historical_weather_data_new]
-        ).unique(["datetime", "latitude", "longitude"])
+        start_index = data[time_col].search_sorted(
+            pl.Series([min_datetime]).cast(data[time_col].dtype), side='left'
+        ).item()
+        if start_index == 0:
+            return data
         
-        self.starting_target_data = pl.concat([self.starting_target_data, target_data_new]).unique(
-            ["datetime", "county", "is_business", "product_type", "is_consumption"]
-        )
-
-     
-    def scan_all_dataset(self) -> None:
+        #copy retained rows so evicted buffer is released
+        return data.slice(start_index).shrink_to_fit()
         
-        self.location_data: pl.LazyFrame = pl.scan_csv(
-            os.path.join(
-                self.config_dict['PATH_MAPPING_DATA'], 'weather_station_to_county_mapping.csv'
-            )
-        )
+    def evict_starting_dataset(self) -> None:
+        #rows older than inference lookback are never used again -> memory stays flat during live
+        if self.main_data.height == 0:
+            return
         
-        self.starting_client_data : pl.LazyFrame = pl.scan_csv(
-            os.path.join(
-                self.path_original_data, 'client.csv'
-            )
+        min_datetime = self.main_data['datetime'].min() - timedelta(days=self.inference_lookback_day)
+        
+        self.starting_client_data = self._evict_dataset(
+            data=self.starting_client_data, dataset_name='client', min_datetime=min_datetime
         )
-        self.main_data: pl.LazyFrame = pl.scan_csv(
-            os.path.join(
-                self.path_original_data, 'train.csv'
-            )
+        self.starting_gas_data = self._evict_dataset(
+            data=self.starting_gas_data, dataset_name='gas', min_datetime=min_datetime
+        )
+        self.starting_electricity_data = self._evict_dataset(
+            data=self.starting_electricity_data, dataset_name='electricity', min_datetime=min_datetime
+        )
+        self.starting_forecast_weather_data = self._evict_dataset(
+            data=self.starting_forecast_weather_data, dataset_name='forecast_weather', min_datetime=min_datetime
+        )
+        self.starting_historical_weather_data = self._evict_dataset(
+            data=self.starting_historical_weather_data, dataset_name='historical_weather', min_datetime=min_datetime
         )
+        self.starting_target_data = self._evict_dataset(
+            data=self.starting_target_data, dataset_name='target', min_datetime=min_datetime
+        )
+
+    def _upsert_dataset(self, data: pl.DataFrame, new_data: pl.DataFrame, dataset_name: str) -> pl.DataFrame:
+        #data is sorted by time -> only rows not older than new data can share a key with it
+        key_list = self.starting_dataset_key_dict[dataset_name]
+        time_col = key_list[0]
+        
+        if new_data.height == 0:
+            return data
+        
+        new_data = new_data.unique(key_list, keep='last')
+        start_index = data[time_col].search_sorted(
+            new_data.select(pl.col(time_col).min()).to_series(), side='left'
+        ).item()
+        
+        #new row replace old one with same key
+        tail_data = data.slice(start_index).join(
+            new_data.select(key_list), on=key_list, how='anti'
+        )
+        data = pl.concat(
+            [
+                data.slice(0, start_index),
+                pl.concat([tail_data, new_data]).sort(time_col)
+            ], rechunk=False
+        )
+        if data.n_chunks() > self.max_store_chunk:
+            data = data.rechunk()
+        
+        return data
 
-        self.starting_electricity_data: pl.LazyFrame = pl.scan_csv(
-            os.path.join(
-                self.path_original_data, 
-                'electricity_prices.csv'
+    def _append_new_data(
+            self, data: Union[pl.LazyFrame, pl.DataFrame], 
+            new_data: Union[pl.LazyFrame, pl.DataFrame], dataset_name: str
+        ) -> Union[pl.LazyFrame, pl.DataFrame]:
+        
+        if isinstance(data, pl.LazyFrame):
+            #appending phase before training -> keep lazy plan
+            return pl.concat([data, new_data]).unique(
+                self.starting_dataset_key_dict[dataset_name]
             )
+        
+        #live phase -> cost depends only on new batch size
+        return self._upsert_dataset(
+            data=data, new_data=new_data, dataset_name=dataset_name
         )
-        self.starting_gas_data: pl.LazyFrame = pl.scan_csv(
-            os.path.join(
+     
+    def scan_all_dataset(self) -> None:
+        self.starting_dataset_path_dict: Dict[str, str] = {
+            'location': os.path.join(
+                self.config_dict['PATH_MAPPING_DATA'], 'weather_station_to_county_mapping.csv'
+            ),
+            'client': os.path.join(
+                self.path_original_data, 'client.csv'
+            ),
+            'train': os.path.join(
+                self.path_original_data, 'train.csv'
+            ),
+            'electricity': os.path.join(
+                self.path_original_data, 'electricity_prices.csv'
+            ),
+            'gas': os.path.join(
                 self.path_original_data, 'gas_prices.csv'
-            )
-        )
-        self.starting_forecast_weather_data: pl.LazyFrame = pl.scan_csv(
-            os.path.join(
+            ),
+            'forecast_weather': os.path.join(
                 self.path_original_data, 'forecast_weather.csv'
-            )
-        )
-        self.starting_historical_weather_data: pl.LazyFrame = pl.scan_csv(
-            os.path.join(
+            ),
+            'historical_weather': os.path.join(
                 self.path_original_data, 'historical_weather.csv'
-            )
-        )
-        
-    #CLIENT
-    def downcast_client(self) -> None:
-        self.starting_client_data = self.starting_client_data.select(
-            self.starting_dataset_column_dict['client']
-        ).with_columns(
-            pl.col('product_type').cast(pl.UInt8),
-            pl.col('county').cast(pl.UInt8),
-            pl.col('eic_count').cast(pl.UInt16),
-            pl.col('installed_capacity').cast(pl.Float32),
-            pl.col('is_business').cast(pl.UInt8),
-            pl.col('date').cast(pl.Date)
+            ),
+        }
+        #mapping is tiny and county can be written as float -> cast after scan
+        self.location_data: pl.LazyFrame = pl.scan_csv(
+            self.starting_dataset_path_dict['location']
+        ).select(
+            self.starting_dataset_column_dict['location']
+        ).cast(self.dataset_schema_dict['location'])
+        self.starting_client_data : pl.LazyFrame = self._scan_csv_dataset('client')
+        self.main_data: pl.LazyFrame = self._scan_csv_dataset('train')
+        self.starting_electricity_data: pl.LazyFrame = self._scan_csv_dataset('electricity')
+        self.starting_gas_data: pl.LazyFrame = self._scan_csv_dataset('gas')
+        self.starting_forecast_weather_data: pl.LazyFrame = self._scan_csv_dataset('forecast_weather')
+        self.starting_historical_weather_data: pl.LazyFrame = self._scan_csv_dataset('historical_weather')
+    
+    def _scan_csv_dataset(self, dataset_name: str) -> pl.LazyFrame:
+        #csv reader parses used column directly in final dtype -> no string cast after scan
+        return pl.scan_csv(
+            self.starting_dataset_path_dict[dataset_name],
+            dtypes=self.dataset_schema_dict[dataset_name]
+        ).select(
+            self.starting_dataset_column_dict[dataset_name]
         )
+    
+    def _get_source_fingerprint(self, dataset_name: str) -> list:
+        #file stat of the source -> no read of the data
+        source_path = self.starting_dataset_path_dict[dataset_name]
+        source_stat = os.stat(source_path)
+        return [
+            os.path.abspath(source_path), 
+            source_stat.st_size, source_stat.st_mtime_ns
+        ]
+    
+    def _get_cache_file_name(self, dataset_name: str, data: pl.LazyFrame) -> str:
+        #any change of source file or used schema gives a new key
+        cache_key = hashlib.md5(
+            json.dumps(
+                {
+                    'source': self._get_source_fingerprint(dataset_name),
+                    'column': self.starting_dataset_column_dict[dataset_name],
+                    'schema': {
+                        col: str(dtype) 
+                        for col, dtype in data.schema.items()
+                    }
+                }
+            ).encode()
+        ).hexdigest()
+        return f'{dataset_name}_{cache_key}.parquet'
 
-    #GAS
-    def downcast_gas_data(self) -> None:
-        self.starting_gas_data = self.starting_gas_data.select(
-            self.starting_dataset_column_dict['gas']
-        ).with_columns(
-            pl.col('forecast_date').str.to_datetime(),
-            pl.col('lowest_price_per_mwh').cast(pl.Float32),
-            pl.col('highest_price_per_mwh').cast(pl.Float32),
+    def _scan_cached_dataset(self, dataset_name: str, data: pl.LazyFrame) -> pl.LazyFrame:
+        path_cache = self.config_dict['PATH_CACHE_DATA']
+        cache_path = os.path.join(
+            path_cache, self._get_cache_file_name(dataset_name=dataset_name, data=data)
         )
+        
+        if not os.path.exists(cache_path):
+            #remove outdated cache of the same dataset
+            for old_cache_path in glob(os.path.join(path_cache, f'{dataset_name}_*.parquet')):
+                os.remove(old_cache_path)
 
-    #ELECTRICITY
-    def downcast_electricity(self) -> None:
-        self.starting_electricity_data = self.starting_electricity_data.select(
-            self.starting_dataset_column_dict['electricity']
-        ).with_columns(
-            (
-                pl.col('forecast_date').str.to_datetime(),
-                pl.col('euros_per_mwh').cast(pl.Float32)
-            )
-        )
+            print(f'Caching {dataset_name} dataset')
+            #write on temporary file so a killed run doesn't leave a corrupted cache
+            data.collect().write_parquet(cache_path + '.tmp')
+            os.replace(cache_path + '.tmp', cache_path)
             
-    #LOCATION
-    def downcast_location(self) -> None:        
-        self.location_data = self.location_data.select(
-            self.starting_dataset_column_dict['location']
-        ).with_columns(
-            pl.col('county').cast(pl.UInt8),
-            pl.col('longitude').cast(pl.Float32),
-            pl.col('latitude').cast(pl.Float32)
+        return pl.scan_parquet(cache_path)
+
+    def cache_starting_dataset(self) -> None:
+        #downcasted dataset are parsed from csv only once, then scanned from parquet
+        if not os.path.isdir(self.config_dict['PATH_CACHE_DATA']):
+            os.makedirs(self.config_dict['PATH_CACHE_DATA'])
+
+        self.location_data = self._scan_cached_dataset(
+            'location', self.location_data
         )
-    
-    #FORECAST WEATHER
-    def downcast_forecast_weather_data(self) -> None:
-        #downcast data
-        self.starting_forecast_weather_data = self.starting_forecast_weather_data.select(
-            self.starting_dataset_column_dict['forecast_weather']
-        ).with_columns(
-            (
-                pl.col('latitude').cast(pl.Float32),
-                pl.col('longitude').cast(pl.Float32),
-                pl.col('hours_ahead').cast(pl.UInt8),
-                pl.col('temperature').cast(pl.Float32),
-                pl.col('dewpoint').cast(pl.Float32),
-                pl.col('cloudcover_high').cast(pl.Float64),
-                pl.col('cloudcover_low').cast(pl.Float64),
-                pl.col('cloudcover_mid').cast(pl.Float64),
-                pl.col('cloudcover_total').cast(pl.Float64),
-                pl.col('10_metre_u_wind_component').cast(pl.Float64),
-                pl.col('10_metre_v_wind_component').cast(pl.Float64),
-                pl.col('direct_solar_radiation').cast(pl.Float64),
-                pl.col('surface_solar_radiation_downwards').cast(pl.Float64),
-                pl.col('snowfall').cast(pl.Float64),
-                pl.col('total_precipitation').cast(pl.Float64),
-                pl.col('origin_datetime').str.to_datetime()
-            )
+        self.starting_client_data = self._scan_cached_dataset(
+            'client', self.starting_client_data
+        )
+        self.main_data = self._scan_cached_dataset(
+            'train', self.main_data
+        )
+        self.starting_electricity_data = self._scan_cached_dataset(
+            'electricity', self.starting_electricity_data
+        )
+        self.starting_gas_data = self._scan_cached_dataset(
+            'gas', self.starting_gas_data
+        )
+        self.starting_forecast_weather_data = self._scan_cached_dataset(
+            'forecast_weather', self.starting_forecast_weather_data
+        )
+        self.starting_historical_weather_data = self._scan_cached_dataset(
+            'historical_weather', self.starting_historical_weather_data
         )
         
-    #FORECAST WEATHER
-    def downcast_historical_weather_data(self) -> None:        
-        #downcast data
-        self.starting_historical_weather_data = self.starting_historical_weather_data.select(
-            self.starting_dataset_column_dict['historical_weather']
-        ).with_columns(
-            (
-                pl.col('datetime').str.to_datetime(),
-                pl.col('temperature').cast(pl.Float32),
-                pl.col('dewpoint').cast(pl.Float32),
-                pl.col('rain').cast(pl.Float32),
-                pl.col('snowfall').cast(pl.Float32),
-                pl.col('surface_pressure').cast(pl.Float32),
-                pl.col('cloudcover_total').cast(pl.UInt8),
-                pl.col('cloudcover_low').cast(pl.UInt8),
-                pl.col('cloudcover_mid').cast(pl.UInt8),
-                pl.col('cloudcover_high').cast(pl.UInt8),
-                pl.col('windspeed_10m').cast(pl.Float32),
-                pl.col('winddirection_10m').cast(pl.UInt16),
-                pl.col('shortwave_radiation').cast(pl.UInt16),
-                pl.col('direct_solar_radiation').cast(pl.UInt16),
-                pl.col('diffuse_radiation').cast(pl.UInt16),
-                pl.col('latitude').cast(pl.Float32),
-                pl.col('longitude').cast(pl.Float32),
-            )
+    #HISTORICAL WEATHER
+    def unique_historical_weather_data(self) -> None:        
         #take out duplicates from train
-        ).unique(
+        self.starting_historical_weather_data = self.starting_historical_weather_data.unique(
             ['latitude', 'longitude', 'datetime']
         )
-        
-    #TRAIN
-    def downcast_train(self) -> None:
-        self.main_data = self.main_data.select(
-            self.starting_dataset_column_dict['train']
-        ).with_columns(
-            (
-                pl.col('county').cast(pl.UInt8),
-                pl.col('is_business').cast(pl.UInt8),
-                pl.col('product_type').cast(pl.UInt8),
-                pl.col('target').cast(pl.Float64),
-                pl.col('is_consumption').cast(pl.UInt8),
-                pl.col('datetime').str.to_datetime(),
-                pl.col('row_id').cast(pl.UInt32)
-            )
-        )
 
     def filter_train(self) -> None:
         self.main_data = self.main_data.filter(
             pl.col("datetime") >= pd.to_datetime("2022-01-01")
         )
         
-    def memorize_starting_dataset_schema(self) -> None:
-        self.starting_dataset_schema_dict: Dict[str, OrderedDict] = {
-            'client': self.starting_client_data.schema,
-            'electricity': self.starting_electricity_data.schema,
-            'forecast_weather': self.starting_forecast_weather_data.schema,
-            'gas': self.starting_gas_data.schema,
-            'historical_weather': self.starting_historical_weather_data.schema,
-            'location': self.location_data.schema,
-            'train': self.main_data.schema,
-            'target': self.starting_target_data.schema
-        }
-    
     def create_target_data(self) -> None:
         self.starting_target_data: pl.LazyFrame = self.main_data.select(
             self.starting_dataset_column_dict['target']
@@ -390,15 +376,9 @@ class EnefitImport(EnefitInit):
     
     def import_all(self) -> None:
         self.scan_all_dataset()
+        self.unique_historical_weather_data()
         
-        self.downcast_client()
-        self.downcast_electricity()
-        self.downcast_forecast_weather_data()
-        self.downcast_gas_data()
-        self.downcast_historical_weather_data()
-        self.downcast_location()
-        self.downcast_train()
+        if self.use_raw_cache:
+            self.cache_starting_dataset()
 
         self.create_target_data()
-        
-        self.memorize_starting_dataset_schema()
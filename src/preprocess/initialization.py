@@ -1,23 +1,52 @@
 import polars as pl
+
+from datetime import date, datetime
 from typing import Any, Union, Dict
 
 class EnefitInit():
     def __init__(self, 
             config_dict: dict[str, Any], target_n_lags: int, 
-            embarko_skip: int
+            embarko_skip: int, use_raw_cache: bool = False,
+            required_feature_list: list[str] = None, use_feature_cache: bool = False,
+            use_incremental_inference: bool = False
         ):
         
         self.target_n_lags: int = target_n_lags
+        #unit of target lag and statistic of target aggregation
+        self.target_key_list: list[str] = ['county', 'is_business', 'product_type', 'is_consumption']
+        self.target_stat_list: list[str] = ['avg', 'sum', 'min', 'max', 'std']
+        #history needed by inference feature: target lags plus one month of margin
+        self.inference_lookback_day: int = target_n_lags + 31
+        #hours ahead of forecast weather used as feature
+        self.forecast_min_hour: int = 22
+        self.forecast_max_hour: int = 45
         self.path_original_data: str = config_dict['PATH_ORIGINAL_DATA']
         self.config_dict: dict[str, Any] = config_dict
         self.embarko_skip: int = embarko_skip
         self.n_folds: int = config_dict['N_FOLD']
         self.fold_time_col: str = 'date_order_kfold'
+        #one UInt8 column {fold_name}_{fold} for each fold: 0 not used, 1 train, 2 valid
+        self.fold_name: str = 'fold_info'
+        self.fold_code_dict: Dict[str, int] = {'n': 0, 't': 1, 'v': 2}
         self.inference: bool = False
+        self.use_raw_cache: bool = use_raw_cache
+        #feature read by the model -> None calculate every feature
+        self.required_feature_list: list[str] = required_feature_list
+        self.required_feature_set: set[str] = None
+        self.use_feature_cache: bool = use_feature_cache
+        #live loop keeps target lag in a ring buffer updated by each new batch instead of the target store
+        self.use_incremental_inference: bool = use_incremental_inference
+        self.target_lag_state = None
+        #memory cap of training preprocessing -> None keeps the whole dataset in memory
+        self.preprocess_memory_budget_gb: float = config_dict.get('PREPROCESS_MEMORY_BUDGET_GB', None)
+        #target number of rows of each data.parquet row group, aligned on era
+        self.parquet_row_group_size: int = 100_000
 
         self._initialiaze_empty_dataset()
         self._initialize_used_column()
-        self._initialize_pandas_schema()
+        self._initialize_dataset_schema()
+        self._initialize_dataset_key()
+        self._initialize_feature_group()
         
     def _initialiaze_empty_dataset(self):
         self.client_data: Union[pl.LazyFrame, pl.DataFrame] = None
@@ -44,77 +73,6 @@ class EnefitInit():
         
         self.data: Union[pl.LazyFrame, pl.DataFrame] = None
     
-    def _initialize_pandas_schema(self) -> None:
-        self.pandas_dataset_schema_dict: Dict[str, Dict[str, str]] = {
-            'client': {
-                'product_type': 'int8',
-                'county': 'int8',
-                'eic_count': 'int16',
-                'installed_capacity': 'float32',
-                'is_business': 'bool'
-            },
-            'electricity': {
-                'euros_per_mwh': 'float32',
-            },
-            'forecast_weather': {
-                'latitude': 'float32',
-                'longitude': 'float32',
-                'hours_ahead': 'int8',
-                'temperature': 'float32',
-                'dewpoint': 'float32',
-                'cloudcover_high': 'float64',
-                'cloudcover_low': 'float64',
-                'cloudcover_mid': 'float64',
-                'cloudcover_total': 'float64',
-                '10_metre_u_wind_component': 'float64',
-                '10_metre_v_wind_component': 'float64',
-                'direct_solar_radiation': 'float64',
-                'surface_solar_radiation_downwards': 'float64',
-                'snowfall': 'float64',
-                'total_precipitation': 'float64'
-            },
-            'gas': {
-                'lowest_price_per_mwh': 'float32',
-                'highest_price_per_mwh': 'float32',
-            },
-            'historical_weather': {
-                'temperature': 'float32',
-                'dewpoint': 'float32',
-                'rain': 'float32',
-                'snowfall': 'float32',
-                'surface_pressure': 'float32',
-                'cloudcover_total': 'int32',
-                'cloudcover_low': 'int32',
-                'cloudcover_mid': 'int32',
-                'cloudcover_high': 'int32',
-                'windspeed_10m': 'float32',
-                'winddirection_10m': 'int32',
-                'shortwave_radiation': 'int32',
-                'direct_solar_radiation': 'int32',
-                'diffuse_radiation': 'int32',
-                'latitude': 'float32',
-                'longitude': 'float32'
-            },
-            'test': {
-                'county': 'int8',
-                'is_business': 'bool',
-                'product_type': 'int8',
-                'is_consumption': 'bool',
-                'row_id': 'int32',
-                'prediction_unit_id': 'int16',
-                'currently_scored': 'bool'
-            },
-            'target': {
-                'county': 'int8',
-                'is_business': 'bool',
-                'product_type': 'int8',
-                'target': 'float64',
-                'is_consumption': 'bool',
-                'row_id': 'int32',
-                'prediction_unit_id': 'int16'
-            }
-        }
-
     def _initialize_used_column(self) -> None:
         self.starting_dataset_column_dict: Dict[str, list[str]] = {
             'client': [
@@ -196,5 +154,160 @@ class EnefitInit():
             ] 
         }
 
+    def _initialize_dataset_schema(self) -> None:
+        #single source of truth for dtype -> used by csv scan and by live update
+        self.dataset_schema_dict: Dict[str, Dict[str, pl.PolarsDataType]] = {
+            'client': {
+                'product_type': pl.UInt8,
+                'county': pl.UInt8,
+                'eic_count': pl.UInt16,
+                'installed_capacity': pl.Float32,
+                'is_business': pl.UInt8,
+                'date': pl.Date
+            },
+            'electricity': {
+                'forecast_date': pl.Datetime('us'),
+                'euros_per_mwh': pl.Float32,
+            },
+            'forecast_weather': {
+                'latitude': pl.Float32,
+                'longitude': pl.Float32,
+                'hours_ahead': pl.UInt8,
+                'temperature': pl.Float32,
+                'dewpoint': pl.Float32,
+                'cloudcover_high': pl.Float64,
+                'cloudcover_low': pl.Float64,
+                'cloudcover_mid': pl.Float64,
+                'cloudcover_total': pl.Float64,
+                '10_metre_u_wind_component': pl.Float64,
+                '10_metre_v_wind_component': pl.Float64,
+                'origin_datetime': pl.Datetime('us'),
+                'direct_solar_radiation': pl.Float64,
+                'surface_solar_radiation_downwards': pl.Float64,
+                'snowfall': pl.Float64,
+                'total_precipitation': pl.Float64
+            },
+            'gas': {
+                'forecast_date': pl.Datetime('us'),
+                'lowest_price_per_mwh': pl.Float32,
+                'highest_price_per_mwh': pl.Float32,
+            },
+            'historical_weather': {
+                'datetime': pl.Datetime('us'),
+                'temperature': pl.Float32,
+                'dewpoint': pl.Float32,
+                'rain': pl.Float32,
+                'snowfall': pl.Float32,
+                'surface_pressure': pl.Float32,
+                'cloudcover_total': pl.UInt8,
+                'cloudcover_low': pl.UInt8,
+                'cloudcover_mid': pl.UInt8,
+                'cloudcover_high': pl.UInt8,
+                'windspeed_10m': pl.Float32,
+                'winddirection_10m': pl.UInt16,
+                'shortwave_radiation': pl.UInt16,
+                'direct_solar_radiation': pl.UInt16,
+                'diffuse_radiation': pl.UInt16,
+                'latitude': pl.Float32,
+                'longitude': pl.Float32
+            },
+            'location': {
+                'longitude': pl.Float32,
+                'latitude': pl.Float32,
+                'county': pl.UInt8
+            },
+            'train': {
+                'county': pl.UInt8,
+                'is_business': pl.UInt8,
+                'product_type': pl.UInt8,
+                'target': pl.Float64,
+                'is_consumption': pl.UInt8,
+                'datetime': pl.Datetime('us'),
+                'row_id': pl.UInt32
+            },
+        }
+        #target and test are a subset of train
+        for dataset_name in ['target', 'test']:
+            self.dataset_schema_dict[dataset_name] = {
+                col: self.dataset_schema_dict['train'][col]
+                for col in self.starting_dataset_column_dict[dataset_name]
+            }
+
+        self.starting_dataset_schema_dict: Dict[str, Dict[str, pl.PolarsDataType]] = {
+            dataset_name: {
+                col: self.dataset_schema_dict[dataset_name][col]
+                for col in column_list
+            }
+            for dataset_name, column_list in self.starting_dataset_column_dict.items()
+        }
+
+    def _initialize_dataset_key(self) -> None:
+        #unique key of each starting dataset, first element is the time column used as index
+        self.starting_dataset_key_dict: Dict[str, list[str]] = {
+            'client': ["date", "county", "is_business", "product_type"],
+            'electricity': ["forecast_date"],
+            'forecast_weather': ["origin_datetime", "latitude", "longitude", "hours_ahead"],
+            'gas': ["forecast_date"],
+            'historical_weather': ["datetime", "latitude", "longitude"],
+            'train': ["datetime", "county", "is_business", "product_type", "is_consumption"],
+            'target': ["datetime", "county", "is_business", "product_type", "is_consumption"],
+        }
+        #after this number of chunk the live store is rechunked
+        self.max_store_chunk: int = 64
+
+    def _initialize_feature_group(self) -> None:
+        #dataset created by each feature group, dataset and parameter read by it, in creation order
+        self.feature_group_dict: Dict[str, Dict[str, list[str]]] = {
+            'client': {'output': 'client_data', 'input': ['client_data'], 'param': []},
+            'electricity': {'output': 'electricity_data', 'input': ['electricity_data'], 'param': []},
+            'forecast_weather': {
+                'output': 'forecast_weather_data', 
+                'input': ['forecast_weather_data', 'location_data'],
+                'param': ['forecast_min_hour', 'forecast_max_hour']
+            },
+            'gas': {'output': 'gas_data', 'input': ['gas_data'], 'param': []},
+            'historical_weather': {
+                'output': 'historical_weather_data', 
+                'input': ['historical_weather_data', 'location_data'],
+                'param': []
+            },
+            'train': {'output': 'main_data', 'input': ['main_data'], 'param': []},
+            'target': {
+                'output': 'target_data', 
+                'input': ['target_data', 'main_data'], 
+                'param': ['target_n_lags', 'target_key_list', 'target_stat_list']
+            },
+        }
+        #starting dataset each feature group input is read from
+        self.feature_input_dataset_dict: Dict[str, list[str]] = {
+            'client_data': ['client'],
+            'electricity_data': ['electricity'],
+            'forecast_weather_data': ['forecast_weather'],
+            'gas_data': ['gas'],
+            'historical_weather_data': ['historical_weather'],
+            'location_data': ['location'],
+            'main_data': ['train'],
+            'target_data': ['train', 'target'],
+        }
+        #hash of each batch appended before training, by starting dataset
+        self.appended_fingerprint_dict: Dict[str, list] = {
+            dataset_name: [] 
+            for dataset_name in [
+                'client', 'gas', 'electricity', 'forecast_weather', 
+                'historical_weather', 'target', 'train'
+            ]
+        }
+
     def _collect_item_utils(self, data: Union[pl.DataFrame, pl.LazyFrame]) -> Any:
-        return data.item() if self.inference else data.collect().item()
\ No newline at end of file
+        return data.collect().item() if isinstance(data, pl.LazyFrame) else data.item()
+    
+    def _slice_time_range(
+            self, data: pl.DataFrame, dataset_name: str, 
+            start: Union[date, datetime], end: Union[date, datetime]
+        ) -> pl.DataFrame:
+        #starting dataset are sorted by time during inference -> rows in [start, end) by binary search
+        time_col = self.starting_dataset_key_dict[dataset_name][0]
+        start_index, end_index = data[time_col].search_sorted(
+            pl.Series([start, end]).cast(data[time_col].dtype), side='left'
+        ).to_list()
+        return data.slice(start_index, end_index - start_index)
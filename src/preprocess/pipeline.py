@@ -1,7 +1,14 @@
 import os
 import gc
+import json
+import numpy as np
+import hashlib
+import polars as pl
+import pyarrow.parquet as pq
 
-from typing import Any
+from glob import glob
+from datetime import timedelta
+from typing import Any, Dict
 
 from src.preprocess.import_data import EnefitImport
 from src.preprocess.add_feature import EnefitFeature
@@ -10,34 +17,302 @@ from src.preprocess.initialization import EnefitInit
 
 class EnefitPipeline(EnefitImport, EnefitFeature, EnefitFoldCreator):
 
-    def __init__(self, config_dict: dict[str, Any], target_n_lags: int, embarko_skip: int):
+    def __init__(self, 
+            config_dict: dict[str, Any], target_n_lags: int, embarko_skip: int, 
+            use_raw_cache: bool = False, required_feature_list: list[str] = None,
+            use_feature_cache: bool = False, use_incremental_inference: bool = False
+        ):
                 
         EnefitInit.__init__(
             self, 
             config_dict=config_dict, 
             target_n_lags=target_n_lags, 
-            embarko_skip=embarko_skip
+            embarko_skip=embarko_skip,
+            use_raw_cache=use_raw_cache,
+            required_feature_list=required_feature_list,
+            use_feature_cache=use_feature_cache,
+            use_incremental_inference=use_incremental_inference
         )
+        self.trace_required_feature()
         self.import_all()
         
-    def save_data(self) -> None:
-        print('saving processed dataset')
-        self.data.write_parquet(
+    def _open_data_writer(self, data: pl.DataFrame) -> pq.ParquetWriter:
+        return pq.ParquetWriter(
             os.path.join(
                 self.config_dict['PATH_PARQUET_DATA'],
                 'data.parquet'
+            ),
+            schema=data.head(0).to_arrow().schema,
+            #wide float feature gain nothing from dictionary encoding
+            compression='zstd', use_dictionary=False, write_statistics=True
+        )
+    
+    def _write_data(self, writer: pq.ParquetWriter, data: pl.DataFrame) -> None:
+        #rows sorted by era and each row group holds whole eras ->
+        #fold and date range read skip row group by min/max statistics.
+        #main_data is sorted before the merge, left joins keep its order
+        assert data[self.fold_time_col].is_sorted()
+        era_count_list = data.group_by(
+            self.fold_time_col, maintain_order=True
+        ).agg(pl.count())['count'].to_list()
+        
+        start_row, row_group_size = 0, 0
+        for era_count in era_count_list:
+            if (row_group_size > 0) and (row_group_size + era_count > self.parquet_row_group_size):
+                writer.write_table(
+                    data.slice(start_row, row_group_size).to_arrow(), 
+                    row_group_size=row_group_size
+                )
+                start_row += row_group_size
+                row_group_size = 0
+            
+            row_group_size += era_count
+        
+        if row_group_size > 0:
+            writer.write_table(
+                data.slice(start_row, row_group_size).to_arrow(), 
+                row_group_size=row_group_size
+            )
+    
+    def save_data_manifest(self, schema: Dict[str, pl.PolarsDataType], number_rows: int) -> None:
+        #describe data.parquet: schema, fold columns with their code and version of each feature group
+        with open(
+            os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'data_manifest.json'
+            ), 'w'
+        ) as file:
+            json.dump(
+                {
+                    'number_rows': number_rows,
+                    'sort_col': self.fold_time_col,
+                    'row_group_size': self.parquet_row_group_size,
+                    'fold_name': self.fold_name,
+                    'fold_col_list': [f'{self.fold_name}_{fold_}' for fold_ in range(self.n_folds)],
+                    'fold_code_dict': self.fold_code_dict,
+                    'schema': {col: str(dtype) for col, dtype in schema.items()},
+                    'feature_group_version': {
+                        feature_group: hashlib.md5(
+                            json.dumps(
+                                {
+                                    'code': self._get_preprocess_code_version(),
+                                    'param': {
+                                        param: getattr(self, param)
+                                        for param in group_info['param']
+                                    }
+                                }
+                            ).encode()
+                        ).hexdigest()
+                        for feature_group, group_info in self.feature_group_dict.items()
+                    },
+                    'required_feature': self.required_feature_list
+                }, 
+                file, indent=4
             )
+            
+    def save_fold_index(self) -> None:
+        #row position of each fold inside data.parquet, as written on disk
+        fold_data = pl.read_parquet(
+            os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'data.parquet'
+            ),
+            columns=[f'{self.fold_name}_{fold_}' for fold_ in range(self.n_folds)]
         )
+        fold_index_dict = {}
+        for fold_ in range(self.n_folds):
+            fold_code = fold_data[f'{self.fold_name}_{fold_}'].to_numpy()
+            fold_index_dict[f'train_{fold_}'] = np.flatnonzero(fold_code == self.fold_code_dict['t'])
+            fold_index_dict[f'valid_{fold_}'] = np.flatnonzero(fold_code == self.fold_code_dict['v'])
+        
+        np.savez(
+            os.path.join(
+                self.config_dict['PATH_PARQUET_DATA'],
+                'fold_index.npz'
+            ),
+            **fold_index_dict
+        )
+
+    def save_data(self) -> None:
+        print('saving processed dataset')
+        writer = self._open_data_writer(self.data)
+        self._write_data(writer=writer, data=self.data)
+        writer.close()
+        
+        self.save_data_manifest(schema=self.data.schema, number_rows=self.data.height)
+        self.save_fold_index()
+
+    def save_data_by_chunk(self) -> None:
+        #main_data is merged and saved by group of dates inside the memory budget.
+        #per date feature group are calculated once on the whole history,
+        #target feature only for the chunk from the target history of its lags
+        print('saving processed dataset by chunk')
+        memory_budget = self.preprocess_memory_budget_gb * 1024**3
+        
+        main_data = self.main_data
+        self.create_fold_split(main_data)
+        
+        #narrow source of target lag, read once
+        target_source = self.target_data.with_columns(
+            pl.col('datetime').dt.date().cast(pl.Date).alias('date')
+        ).collect()
+        
+        count_by_date = main_data.group_by('date').agg(pl.count()).sort('date')
+        date_list, count_list = count_by_date['date'].to_list(), count_by_date['count'].to_list()
+        
+        writer, schema, number_rows = None, None, 0
+        start_date, number_date = 0, 1
+        while start_date < len(date_list):
+            chunk_date_list = date_list[start_date:start_date + number_date]
+            self.main_data = main_data.filter(pl.col('date').is_in(chunk_date_list))
+            
+            #whole dates from the oldest lag -> same daily statistic and lag of the full history
+            self.target_data = target_source.filter(
+                pl.col('date').is_between(
+                    chunk_date_list[0] - timedelta(days=self.target_n_lags), chunk_date_list[-1]
+                )
+            ).drop('date').lazy()
+            self.main_data = self.main_data.lazy()
+            self.create_target_feature()
+            self.main_data = self.main_data.collect()
+            self.target_data = self.target_data.collect()
+            
+            self.merge_all()
+            self.add_additional_feature()
+            assert self.data.height == self.main_data.height
+            
+            self.data = self.add_fold_info(self.data)
+            
+            if writer is None:
+                writer = self._open_data_writer(self.data)
+            self._write_data(writer=writer, data=self.data)
+            
+            schema = self.data.schema
+            number_rows += self.data.height
+            
+            #next chunk size from observed row size -> joined chunk and its sorted copy live together
+            row_size = 2 * self.data.estimated_size() / max(self.data.height, 1)
+            self.data = None
+            _ = gc.collect()
+            
+            start_date += number_date
+            number_date, chunk_row = 0, 0
+            while (
+                (start_date + number_date < len(date_list)) and
+                (
+                    (number_date == 0) or 
+                    ((chunk_row + count_list[start_date + number_date]) * row_size <= memory_budget)
+                )
+            ):
+                chunk_row += count_list[start_date + number_date]
+                number_date += 1
+        
+        writer.close()
+        self.main_data = main_data
+        self.target_data = None
+        
+        self.save_data_manifest(schema=schema, number_rows=number_rows)
+        self.save_fold_index()
+        
     def create_feature(self) -> None:
-        _ = gc.collect()        
+        #live loop allocate only one block -> full collection would cost more than the features
+        if not self.inference:
+            _ = gc.collect()
+        
         
-        self.create_client_feature()
-        self.create_electricity_feature()
-        self.create_forecast_weather_feature()
-        self.create_gas_feature()
-        self.create_historical_weather_feature()
-        self.create_train_feature()
-        self.create_target_feature()
+        for feature_group in self._get_history_feature_group_list():
+            getattr(self, f'create_{feature_group}_feature')()
+    
+    def _get_history_feature_group_list(self) -> list[str]:
+        #feature group calculated once over the whole history.
+        #with a memory budget target feature, one wide row for each main_data row,
+        #is calculated inside each date chunk of save_data_by_chunk
+        if (self.inference) or (self.preprocess_memory_budget_gb is None):
+            return list(self.feature_group_dict.keys())
+        
+        return [
+            feature_group for feature_group in self.feature_group_dict.keys()
+            if feature_group != 'target'
+        ]
+    
+    def _get_preprocess_code_version(self) -> str:
+        #hash of every module of the preprocess package -> any code change invalidates every cached group
+        code_hash = hashlib.md5()
+        for module_path in sorted(glob(os.path.join(os.path.dirname(__file__), '*.py'))):
+            with open(module_path, 'rb') as file:
+                code_hash.update(file.read())
+        return code_hash.hexdigest()
+    
+    def _get_input_fingerprint(self, input_name: str) -> list:
+        #file stat and schema of each source plus hash of appended batch -> no scan of the input
+        return [
+            [
+                (
+                    self._get_source_fingerprint(dataset_name) 
+                    if dataset_name in self.starting_dataset_path_dict else None
+                ),
+                {
+                    col: str(dtype) 
+                    for col, dtype in self.starting_dataset_schema_dict[dataset_name].items()
+                },
+                self.appended_fingerprint_dict.get(dataset_name, [])
+            ]
+            for dataset_name in self.feature_input_dataset_dict[input_name]
+        ]
+    
+    def _get_feature_cache_file_name(self, feature_group: str) -> str:
+        #any change of code, input or parameter of the group gives a new key
+        cache_key = hashlib.md5(
+            json.dumps(
+                {
+                    'code': self._get_preprocess_code_version(),
+                    'input': [
+                        self._get_input_fingerprint(input_name)
+                        for input_name in self.feature_group_dict[feature_group]['input']
+                    ],
+                    'param': {
+                        param: getattr(self, param)
+                        for param in self.feature_group_dict[feature_group]['param']
+                    },
+                    'required_feature': (
+                        None if self.required_feature_set is None
+                        else sorted(self.required_feature_set)
+                    ),
+                    'polars': pl.__version__
+                }
+            ).encode()
+        ).hexdigest()
+        return f'feature_{feature_group}_{cache_key}.parquet'
+
+    def create_cached_feature(self) -> None:
+        #each feature group is stored on its own so only the changed group is recomputed
+        _ = gc.collect()
+        
+        path_cache = self.config_dict['PATH_CACHE_DATA']
+        if not os.path.isdir(path_cache):
+            os.makedirs(path_cache)
+        
+        feature_group_list = self._get_history_feature_group_list()
+        
+        for feature_group in feature_group_list:
+            group_info = self.feature_group_dict[feature_group]
+            cache_path = os.path.join(
+                path_cache, 
+                self._get_feature_cache_file_name(feature_group=feature_group)
+            )
+            if not os.path.exists(cache_path):
+                #remove outdated cache of the same group
+                for old_cache_path in glob(os.path.join(path_cache, f'feature_{feature_group}_*.parquet')):
+                    os.remove(old_cache_path)
+                
+                print(f'Caching {feature_group} feature')
+                getattr(self, f'create_{feature_group}_feature')()
+                
+                #write on temporary file so a killed run doesn't leave a corrupted cache
+                getattr(self, group_info['output']).collect().write_parquet(cache_path + '.tmp')
+                os.replace(cache_path + '.tmp', cache_path)
+                
+            setattr(self, group_info['output'], pl.scan_parquet(cache_path))
         
     def preprocess_inference(self) -> None:
         self.copy_starting_dataset()
@@ -48,26 +323,66 @@ class EnefitPipeline(EnefitImport, EnefitFeature, EnefitFoldCreator):
 
     def preprocess_train(self) -> None:
         self.copy_starting_dataset()
-        self.create_feature()
-        self.merge_all()
-        self.add_additional_feature()
+        if self.use_feature_cache:
+            self.create_cached_feature()
+        else:
+            self.create_feature()
         
         print('Collecting....')
-        self.data = self.data.collect()
-        _ = gc.collect()
+        self.collect_feature_group()
+        self.check_unique_feature_key()
         
-        print('Creating fold_info column ...')
-        self.create_fold()
-        self.save_data()
+        #narrow main_data is sorted instead of the wide merged data
+        self.main_data = self.main_data.sort(
+            [self.fold_time_col] + self.starting_dataset_key_dict['train']
+        )
+        _ = gc.collect()
+
+        if self.preprocess_memory_budget_gb is None:
+            self.merge_all()
+            self.add_additional_feature()
+            #feature key are unique -> single row count check on materialized data
+            assert self.data.height == self.main_data.height
+            
+            print('Creating fold columns ...')
+            self.create_fold()
+            self.save_data()
+        else:
+            self.save_data_by_chunk()
     
+    def collect_feature_group(self) -> None:
+        #feature group plans are independent -> collect them together once, then merge in memory
+        output_name_list = [
+            self.feature_group_dict[feature_group]['output'] 
+            for feature_group in self._get_history_feature_group_list()
+        ]
+        output_data_list = pl.collect_all(
+            [getattr(self, output_name) for output_name in output_name_list]
+        )
+        for output_name, output_data in zip(output_name_list, output_data_list):
+            setattr(self, output_name, output_data)
+            
     def collect_feature(self) -> None:
+        #starting dataset are kept sorted by time to allow keyed append during inference
         self.location_data = self.location_data.collect()
-        self.starting_client_data = self.starting_client_data.collect()
-        self.starting_electricity_data = self.starting_electricity_data.collect()
-        self.starting_forecast_weather_data = self.starting_forecast_weather_data.collect()
-        self.starting_gas_data = self.starting_gas_data.collect()
-        self.starting_historical_weather_data = self.starting_historical_weather_data.collect()
-        self.starting_target_data = self.starting_target_data.collect()
+        self.starting_client_data = self.starting_client_data.collect().sort(
+            self.starting_dataset_key_dict['client'][0]
+        )
+        self.starting_electricity_data = self.starting_electricity_data.collect().sort(
+            self.starting_dataset_key_dict['electricity'][0]
+        )
+        self.starting_forecast_weather_data = self.starting_forecast_weather_data.collect().sort(
+            self.starting_dataset_key_dict['forecast_weather'][0]
+        )
+        self.starting_gas_data = self.starting_gas_data.collect().sort(
+            self.starting_dataset_key_dict['gas'][0]
+        )
+        self.starting_historical_weather_data = self.starting_historical_weather_data.collect().sort(
+            self.starting_dataset_key_dict['historical_weather'][0]
+        )
+        self.starting_target_data = self.starting_target_data.collect().sort(
+            self.starting_dataset_key_dict['target'][0]
+        )
 
     def collect_all(self) -> None:
         self.collect_feature()
@@ -83,6 +398,9 @@ class EnefitPipeline(EnefitImport, EnefitFeature, EnefitFoldCreator):
         #collect to enable append
         self.collect_feature()
         
+        if self.use_incremental_inference:
+            self.init_target_lag_state()
+        
     def __call__(self) -> None:
         if self.inference:
             self.preprocess_inference()
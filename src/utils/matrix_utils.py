@@ -0,0 +1,253 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from typing import Any, Dict, Iterator, Tuple
+from contextlib import contextmanager
+
+def load_feature_matrix(data: pl.DataFrame, feature_list: list[str], order: str = 'C') -> np.ndarray:
+    #single float32 allocation filled column by column from the polars buffers.
+    #order='F' keeps each column contiguous, order='C' each row
+    feature_matrix = np.empty((data.height, len(feature_list)), dtype='float32', order=order)
+
+    for position, col in enumerate(feature_list):
+        #null -> nan
+        feature_matrix[:, position] = data[col].cast(pl.Float32).to_numpy()
+
+    return feature_matrix
+
+def load_target_array(data: pl.DataFrame, target_col: str) -> np.ndarray:
+    #view on the polars buffer when the column is a single null free float64 chunk
+    return data[target_col].cast(pl.Float64).to_numpy()
+
+def load_fold_info(data_folder: str) -> Dict[str, Any]:
+    #fold column of each fold and code of not used/train/valid rows as written by preprocessing
+    with open(os.path.join(data_folder, 'data_manifest.json'), 'r') as file:
+        data_manifest = json.load(file)
+    
+    return {
+        key: data_manifest[key]
+        for key in ['fold_name', 'fold_col_list', 'fold_code_dict']
+    }
+
+def get_candidate_feature_list(column_list: list[str], excluded_col_list: list[str], fold_col_list: list[str]) -> list[str]:
+    #every column usable as feature by a model
+    return [
+        col for col in column_list
+        if col not in excluded_col_list + fold_col_list
+    ]
+
+def export_feature_store(
+        data_path: str, store_path: str, feature_list: list[str], target_col: str,
+        fold_col_list: list[str], date_col: str, data_fingerprint: list, batch_size: int = 65_536
+    ) -> None:
+    #labelled rows of a parquet file, in file order, written by record batch as .npy which every process can memory map:
+    #row major float32 feature, target, fold code of each fold and date as day number.
+    #store is written in a temporary folder and moved in place once complete
+    temp_store_path = f'{store_path}.tmp.{os.getpid()}'
+    shutil.rmtree(temp_store_path, ignore_errors=True)
+    os.makedirs(temp_store_path)
+
+    parquet_file = pq.ParquetFile(data_path)
+    number_rows = pl.read_parquet(data_path, columns=[target_col])[target_col].is_not_null().sum()
+
+    store_dict = {
+        'feature': np.lib.format.open_memmap(
+            os.path.join(temp_store_path, 'feature.npy'), mode='w+', 
+            dtype='float32', shape=(number_rows, len(feature_list))
+        ),
+        'target': np.lib.format.open_memmap(
+            os.path.join(temp_store_path, 'target.npy'), mode='w+', 
+            dtype='float64', shape=(number_rows,)
+        ),
+        'fold': np.lib.format.open_memmap(
+            os.path.join(temp_store_path, 'fold.npy'), mode='w+', 
+            dtype='uint8', shape=(number_rows, len(fold_col_list))
+        ),
+        'date': np.lib.format.open_memmap(
+            os.path.join(temp_store_path, 'date.npy'), mode='w+', 
+            dtype='int32', shape=(number_rows,)
+        ),
+    }
+    start_row = 0
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, columns=feature_list + [target_col, date_col] + fold_col_list
+    ):
+        batch_data = pl.from_arrow(batch).filter(pl.col(target_col).is_not_null())
+        end_row = start_row + batch_data.height
+
+        store_dict['feature'][start_row:end_row] = load_feature_matrix(batch_data, feature_list)
+        store_dict['target'][start_row:end_row] = load_target_array(batch_data, target_col)
+        store_dict['fold'][start_row:end_row] = batch_data.select(fold_col_list).to_numpy()
+        store_dict['date'][start_row:end_row] = batch_data[date_col].cast(pl.Int32).to_numpy()
+        start_row = end_row
+
+    assert start_row == number_rows
+    for array in store_dict.values():
+        array.flush()
+    del store_dict
+
+    with open(os.path.join(temp_store_path, 'manifest.json'), 'w') as file:
+        json.dump(
+            {
+                'data': data_fingerprint,
+                'number_rows': number_rows,
+                'feature_list': feature_list,
+                'fold_col_list': fold_col_list
+            }, 
+            file
+        )
+    
+    #outdated store is removed, process still mapping it keep reading the unlinked files
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(temp_store_path, store_path)
+
+def _is_feature_store_valid(store_path: str, data_fingerprint: list, fold_col_list: list[str]) -> bool:
+    manifest_path = os.path.join(store_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return False
+    
+    with open(manifest_path, 'r') as file:
+        manifest = json.load(file)
+    
+    return (
+        (manifest['data'] == data_fingerprint) and
+        (manifest['fold_col_list'] == fold_col_list)
+    )
+
+@contextmanager
+def _lock_feature_store(lock_path: str) -> Iterator[None]:
+    #exclusive lock on lock_path, released by the os if the process dies.
+    #lock module are platform specific -> imported here so matrix_utils is importable everywhere
+    with open(lock_path, 'w') as lock_file:
+        if os.name == 'nt':
+            import msvcrt
+            #LK_LOCK gives up after 10 attempts -> retry until the exporting process is done
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def prepare_feature_store(
+        data_path: str, store_root_path: str, feature_list: list[str], target_col: str,
+        fold_col_list: list[str], date_col: str
+    ) -> Dict[str, Any]:
+    #one store for each feature list -> a fold is a row selection of the store, never a column gather.
+    #exported once and reused by every trainer and process until data changes
+    feature_hash = hashlib.md5(json.dumps(feature_list).encode()).hexdigest()
+    store_path = os.path.join(store_root_path, feature_hash)
+    
+    data_stat = os.stat(data_path)
+    data_fingerprint = [data_stat.st_size, data_stat.st_mtime_ns]
+    
+    if not _is_feature_store_valid(store_path, data_fingerprint, fold_col_list):
+        if not os.path.isdir(store_root_path):
+            os.makedirs(store_root_path, exist_ok=True)
+        
+        #concurrent process wait the one exporting
+        with _lock_feature_store(f'{store_path}.lock'):
+            #store may have been exported while waiting the lock
+            if not _is_feature_store_valid(store_path, data_fingerprint, fold_col_list):
+                print('Exporting feature store')
+                export_feature_store(
+                    data_path=data_path, store_path=store_path, 
+                    feature_list=feature_list, target_col=target_col, 
+                    fold_col_list=fold_col_list, date_col=date_col, 
+                    data_fingerprint=data_fingerprint
+                )
+    
+    return open_feature_store(store_path)
+
+def open_feature_store(store_path: str) -> Dict[str, Any]:
+    #read only memory map -> every process shares the page cache copy
+    with open(os.path.join(store_path, 'manifest.json'), 'r') as file:
+        feature_store = json.load(file)
+    
+    feature_store['store_path'] = store_path
+    for name in ['feature', 'target', 'fold', 'date']:
+        feature_store[name] = np.load(
+            os.path.join(store_path, f'{name}.npy'), mmap_mode='r'
+        )
+    return feature_store
+
+def get_row_range_list(row_index: np.ndarray) -> list[Tuple[int, int]]:
+    #[start, end) of each run of consecutive rows of a sorted row index
+    if row_index.shape[0] == 0:
+        return []
+    
+    break_position = np.flatnonzero(np.diff(row_index) != 1) + 1
+    start_array = np.concatenate([row_index[:1], row_index[break_position]])
+    end_array = np.concatenate([row_index[break_position - 1], row_index[-1:]]) + 1
+    return list(zip(start_array.tolist(), end_array.tolist()))
+
+def load_store_view_list(feature_store: Dict[str, Any], row_index: np.ndarray) -> Tuple[list[np.ndarray], np.ndarray]:
+    #store rows are in era order -> valid fold is a single range, train at most two around it.
+    #feature of each range is a memory map view, no copy; only target is concatenated
+    range_list = get_row_range_list(row_index)
+    return (
+        [feature_store['feature'][start:end] for start, end in range_list],
+        np.concatenate([feature_store['target'][start:end] for start, end in range_list])
+    )
+
+def get_store_fold_index(
+        feature_store: Dict[str, Any], fold_: int, fold_code_dict: Dict[str, int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    fold_code = feature_store['fold'][:, fold_]
+    train_index = np.flatnonzero(fold_code == fold_code_dict['t'])
+    test_index = np.flatnonzero(fold_code == fold_code_dict['v'])
+    
+    date = feature_store['date']
+    assert np.intersect1d(date[train_index], date[test_index]).shape[0] == 0
+    
+    return train_index, test_index
+
+def get_labelled_fold_index(data_folder: str, target_col: str, fold_: int) -> Tuple[np.ndarray, np.ndarray]:
+    #fold row index of data.parquet -> row index over labelled rows only (binned dataset, feature store)
+    label_data = pl.read_parquet(
+        os.path.join(data_folder, 'data.parquet'),
+        columns=[target_col, 'date']
+    )
+    labelled = label_data[target_col].is_not_null().to_numpy()
+    labelled_position = np.cumsum(labelled) - 1
+    
+    fold_index = np.load(
+        os.path.join(data_folder, 'fold_index.npz')
+    )
+    train_index = fold_index[f'train_{fold_}']
+    train_index = train_index[labelled[train_index]]
+    test_index = fold_index[f'valid_{fold_}']
+    test_index = test_index[labelled[test_index]]
+    
+    date = label_data['date'].to_numpy()
+    assert np.intersect1d(date[train_index], date[test_index]).shape[0] == 0
+    
+    return labelled_position[train_index], labelled_position[test_index]
+
+def load_store_fold(
+        store_path: str, train_index: np.ndarray, test_index: np.ndarray
+    ) -> Dict[str, Tuple[list[np.ndarray], np.ndarray]]:
+    #used by fold worker process: feature view list and target of each split.
+    #every worker maps the same pages, its memory is the model binned matrix only
+    feature_store = open_feature_store(store_path)
+    return {
+        'train': load_store_view_list(feature_store, train_index),
+        'valid': load_store_view_list(feature_store, test_index)
+    }